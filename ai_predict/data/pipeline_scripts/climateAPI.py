@@ -1,24 +1,51 @@
+import argparse
 import asyncio
 import json
+import math
+import shutil
+import numpy as np
 import pandas as pd
-from datetime import date, datetime
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
 from epiweeks import Week
 import logging
 import httpx
 import aiofiles
-import aiofiles.os
 from pathlib import Path
 
 # --- CAMINHOS ROBUSTOS ---
 SCRIPT_DIR = Path(__file__).resolve().parent
 INPUT_FILE = SCRIPT_DIR / "../municipios/municipios.json"
-OUTPUT_FILE = SCRIPT_DIR / "../dadosClimaticos.parquet"
+# Semanas agregadas, um ficheiro por ano epidemiológico (ano_AAAA.parquet)
+OUTPUT_DIR = SCRIPT_DIR / "../dadosClimaticos"
+# Ficheiro único antigo, convertido para partições por ano na primeira execução
+LEGACY_OUTPUT_FILE = SCRIPT_DIR / "../dadosClimaticos.parquet"
+# Dados diários brutos do POWER, uma pasta por célula da grade e um ficheiro por pedido (só acrescenta)
+RAW_DAILY_DIR = SCRIPT_DIR / "../dadosClimaticosDiarios"
+
+# Fragmentos e manifesto da execução em curso; permitem retomar depois de uma falha
+CHECKPOINT_DIR = SCRIPT_DIR / "../.checkpoint_climaticos"
 
 # --- Constantes ---
 PARAMETERS = ["T2M", "T2M_MAX", "T2M_MIN", "PRECTOTCORR", "RH2M", "ALLSKY_SFC_SW_DWN"]
 MAX_REQUESTS_PER_MINUTE = 125
+# Rajada máxima do token bucket (pedidos seguidos sem espera)
+RATE_LIMIT_BURST = 10
 CONCURRENT_TASKS = 30
 MAX_RETRIES = 5
+# Respostas 429 não gastam as tentativas acima; têm um limite próprio por pedido
+MAX_THROTTLED_RETRIES = 20
+# Resolução da grade de meteorologia do POWER (MERRA-2) e da grade solar (CERES, 1°, bordas em graus
+# inteiros). 0.625 não divide 1, então uma célula de meteorologia pode cair em até 4 células solares:
+# os municípios são agrupados pelo par (meteorologia, solar) e só aí recebem os mesmos dados
+GRID_LAT_STEP = 0.5
+GRID_LON_STEP = 0.625
+SOLAR_GRID_STEP = 1.0
+# Células por fragmento gravado no checkpoint
+CHECKPOINT_EVERY = 50
+# Acima deste número de ficheiros, as partes de uma célula são compactadas num só
+RAW_MAX_PARTS = 16
+SERIES_START_WEEK = Week(2014, 1)
 UPDATE_UNTIL_WEEK = Week.fromdate(date.today()) - 3
 
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -26,27 +53,222 @@ logging.getLogger("httpcore").setLevel(logging.WARNING)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
 
 class RateLimiter:
-    def __init__(self, max_per_minute):
-        self.delay = 60 / max_per_minute
+    """Token bucket compartilhado por todas as tarefas, com recuo global em HTTP 429.
+
+    Permite rajadas de até `burst` pedidos e repõe fichas à taxa atual. Um 429
+    bloqueia todas as tarefas até ao fim do Retry-After (ou `default_backoff`)
+    e reduz a taxa para metade; depois disso, os sucessos sobem a taxa de forma
+    linear no tempo, levando `recovery_seconds` para ir do mínimo ao máximo.
+    """
+
+    def __init__(self, max_per_minute, burst=None, min_per_minute=None, default_backoff=60.0, recovery_seconds=300.0):
+        self.max_rate = max_per_minute / 60
+        self.min_rate = (min_per_minute or max_per_minute / 10) / 60
+        self.rate = self.max_rate
+        self.capacity = burst or max(1, max_per_minute // 12)
+        self.tokens = float(self.capacity)
+        self.default_backoff = default_backoff
+        self.recovery_seconds = recovery_seconds
         self.lock = asyncio.Lock()
-        self.last_call = None
+        self.loop_time = asyncio.get_event_loop().time
+        self.updated = self.loop_time()
+        self.started = self.updated
+        self.blocked_until = 0.0
+        self.last_increase = self.updated
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.wait_time = 0.0
 
     async def wait(self):
+        start = self.loop_time()
         async with self.lock:
-            now = asyncio.get_event_loop().time()
-            if self.last_call is not None:
-                elapsed = now - self.last_call
-                if elapsed < self.delay:
-                    await asyncio.sleep(self.delay - elapsed)
-            self.last_call = asyncio.get_event_loop().time()
-
-def get_last_week_for_municipio(df, codigo_ibge):
-    df_mun = df[df["codigo_ibge"] == codigo_ibge]
-    if df_mun.empty:
+            while True:
+                now = self.loop_time()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+                self.updated = max(now, self.updated)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.requests += 1
+        self.wait_time += self.loop_time() - start
+
+    def on_success(self):
+        # Aumento aditivo proporcional ao tempo desde o último ajuste, não ao número de sucessos:
+        # com 30 tarefas em paralelo, contar sucessos devolvia a taxa máxima em poucos segundos
+        now = self.loop_time()
+        if now <= self.last_increase:
+            return
+        step = (self.max_rate - self.min_rate) * (now - self.last_increase) / self.recovery_seconds
+        self.rate = min(self.max_rate, self.rate + step)
+        self.last_increase = now
+
+    def on_throttle(self, retry_after=None):
+        self.throttled += 1
+        now = self.loop_time()
+        # Vários 429 da mesma rajada contam como um só recuo
+        if now >= self.blocked_until:
+            self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, now + (retry_after if retry_after is not None else self.default_backoff))
+        # O balde só volta a encher depois do bloqueio; senão o tempo bloqueado viraria uma rajada
+        # cheia disparada no instante em que o Retry-After expira
+        self.updated = self.blocked_until
+        # A recuperação só conta a partir do fim do bloqueio
+        self.last_increase = self.blocked_until
+
+    def stats(self):
+        elapsed = max(self.loop_time() - self.started, 1e-9)
+        return {
+            "pedidos": self.requests,
+            "pedidos_por_minuto": round(self.requests / elapsed * 60, 1),
+            "taxa_atual_por_minuto": round(self.rate * 60, 1),
+            "limitados_429": self.throttled,
+            "novas_tentativas": self.retries,
+            # Soma das esperas de todas as tarefas na fila do limitador
+            "tempo_de_espera_s": round(self.wait_time, 1),
+        }
+
+def parse_retry_after(value):
+    # Retry-After pode vir em segundos ou como data HTTP
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
         return None
-    last_week_str = df_mun["ano_semana"].max()
-    year, week = map(int, last_week_str.split('/'))
-    return Week(year, week)
+
+def grid_cell(lat, lon):
+    return (round((lat + 90) / GRID_LAT_STEP), round((lon + 180) / GRID_LON_STEP),
+            math.floor(lat / SOLAR_GRID_STEP), math.floor(lon / SOLAR_GRID_STEP))
+
+def cell_center(cell):
+    # Centro da interseção entre a célula de meteorologia e a célula solar
+    i, j, si, sj = cell
+    lat, lon = -90 + i * GRID_LAT_STEP, -180 + j * GRID_LON_STEP
+    lat_lo, lat_hi = max(lat - GRID_LAT_STEP / 2, si * SOLAR_GRID_STEP), min(lat + GRID_LAT_STEP / 2, (si + 1) * SOLAR_GRID_STEP)
+    lon_lo, lon_hi = max(lon - GRID_LON_STEP / 2, sj * SOLAR_GRID_STEP), min(lon + GRID_LON_STEP / 2, (sj + 1) * SOLAR_GRID_STEP)
+    return round((lat_lo + lat_hi) / 2, 4), round((lon_lo + lon_hi) / 2, 4)
+
+def group_by_cell(municipios):
+    cells = {}
+    for m in municipios:
+        cells.setdefault(grid_cell(m["latitude"], m["longitude"]), []).append(m)
+    return cells
+
+def ensure_week_columns(df):
+    # Ficheiros antigos só têm "ano_semana" ("YYYY/WW"); as colunas inteiras são derivadas uma vez
+    if df.empty or {"ano", "semana"} <= set(df.columns):
+        return df
+    df["ano"] = df["ano_semana"].str.slice(0, 4).astype("int16")
+    df["semana"] = df["ano_semana"].str.slice(5, 7).astype("int16")
+    return df
+
+class Checkpoint:
+    """Fragmentos parquet + manifesto da execução atual.
+
+    O manifesto guarda a semana-alvo, os fragmentos já gravados e os
+    municípios concluídos; uma nova execução para a mesma semana-alvo salta
+    esses municípios e junta os fragmentos no fim. No GitHub Actions a pasta
+    é guardada em cache quando a execução falha e restaurada na seguinte
+    (ver weekly_update.yml).
+    """
+
+    def __init__(self, folder, target_week):
+        self.folder = Path(folder)
+        self.manifest_path = self.folder / "manifest.json"
+        self.target = str(target_week)
+        self.fragments = []
+        self.done = set()
+        if self.manifest_path.exists():
+            try:
+                manifest = json.loads(self.manifest_path.read_text(encoding="utf-8"))
+            except ValueError:
+                manifest = {}
+            if manifest.get("semana_alvo") == self.target:
+                self.fragments = [f for f in manifest.get("fragmentos", []) if (self.folder / f).exists()]
+                self.done = set(manifest.get("concluidos", []))
+            else:
+                # Checkpoint de outra semana-alvo: não serve para esta execução
+                self.clear()
+
+    def save(self, df, codes):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        if not df.empty:
+            name = f"fragmento_{len(self.fragments) + 1:05d}.parquet"
+            tmp = self.folder / f"{name}.tmp"
+            df.to_parquet(tmp, index=False, engine='fastparquet')
+            tmp.replace(self.folder / name)
+            self.fragments.append(name)
+        self.done.update(int(c) for c in codes)
+        manifest = {"semana_alvo": self.target, "fragmentos": self.fragments, "concluidos": sorted(self.done)}
+        tmp = self.manifest_path.with_name("manifest.json.tmp")
+        tmp.write_text(json.dumps(manifest), encoding="utf-8")
+        tmp.replace(self.manifest_path)
+
+    def load(self):
+        frames = [pd.read_parquet(self.folder / f, engine='fastparquet') for f in self.fragments]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def clear(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+        self.fragments = []
+        self.done = set()
+
+def partition_path(year):
+    return OUTPUT_DIR / f"ano_{int(year)}.parquet"
+
+def list_partitions():
+    return sorted(OUTPUT_DIR.glob("ano_*.parquet"))
+
+def write_partition(year, df):
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    path = partition_path(year)
+    tmp = path.with_name(path.name + ".tmp")
+    df.to_parquet(tmp, index=False, engine='fastparquet')
+    tmp.replace(path)
+
+def migrate_legacy_file():
+    if list_partitions() or not LEGACY_OUTPUT_FILE.exists():
+        return
+    logging.info(f"A converter {LEGACY_OUTPUT_FILE} em partições por ano em {OUTPUT_DIR}...")
+    df = ensure_week_columns(pd.read_parquet(LEGACY_OUTPUT_FILE, engine='fastparquet'))
+    for year, part in df.groupby("ano"):
+        write_partition(year, part.sort_values(by=["codigo_ibge", "ano", "semana"]))
+
+def read_week_index():
+    # Só as colunas de chave de cada partição, o suficiente para saber onde retomar
+    frames = [pd.read_parquet(p, engine='fastparquet', columns=["codigo_ibge", "ano", "semana"]) for p in list_partitions()]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+def upsert_weekly(df_new):
+    # Reescreve só as partições (anos) que receberam semanas novas
+    touched = []
+    for year, part in df_new.groupby("ano"):
+        path = partition_path(year)
+        if path.exists():
+            old = ensure_week_columns(pd.read_parquet(path, engine='fastparquet'))
+            part = pd.concat([old, part], ignore_index=True)
+            part = part.drop_duplicates(subset=["codigo_ibge", "ano", "semana"], keep="last")
+        write_partition(year, part.sort_values(by=["codigo_ibge", "ano", "semana"]))
+        touched.append(int(year))
+    return touched
+
+def build_resume_index(df):
+    # Última semana epidemiológica disponível por município, num único groupby
+    if df.empty:
+        return {}
+    key = df["ano"].astype("int32") * 100 + df["semana"].astype("int32")
+    last = key.groupby(df["codigo_ibge"]).max()
+    return {int(code): Week(int(k) // 100, int(k) % 100) for code, k in last.items()}
 
 async def fetch_data(client, rate_limiter, lat, lon, start_date, end_date):
     url = "https://power.larc.nasa.gov/api/temporal/daily/point"
@@ -55,72 +277,245 @@ async def fetch_data(client, rate_limiter, lat, lon, start_date, end_date):
         "longitude": lon, "latitude": lat, "start": start_date,
         "end": end_date, "format": "JSON"
     }
-    for attempt in range(MAX_RETRIES):
+    attempt, throttled = 0, 0
+    while attempt < MAX_RETRIES:
+        if attempt or throttled:
+            rate_limiter.retries += 1
         await rate_limiter.wait()
         try:
             response = await client.get(url, params=params, timeout=30)
             if response.status_code == 200:
+                rate_limiter.on_success()
                 return response.json().get("properties", {}).get("parameter", {})
             elif response.status_code == 429:
-                logging.warning("API limitada, a aguardar 60s...")
-                await asyncio.sleep(60)
+                # O recuo é global: o limitador segura todas as tarefas, não só esta
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                rate_limiter.on_throttle(retry_after)
+                logging.warning(f"API limitada (429), pedidos suspensos por {retry_after if retry_after is not None else rate_limiter.default_backoff:.0f}s; "
+                                f"nova taxa {rate_limiter.rate * 60:.0f}/min")
+                throttled += 1
+                if throttled > MAX_THROTTLED_RETRIES:
+                    logging.error(f"Pedido desistido após {throttled} respostas 429.")
+                    return None
+                continue
             else:
                 logging.warning(f"HTTP {response.status_code} na tentativa {attempt+1}")
         except (httpx.RequestError, asyncio.TimeoutError) as e:
             logging.error(f"Erro de pedido na tentativa {attempt+1}: {e}")
         await asyncio.sleep(2 ** attempt)
+        attempt += 1
     return None
 
-def api_data_to_df(name, ibge_code, data):
-    records = []
-    dates = data.get(PARAMETERS[0], {}).keys()
-    for date_str in dates:
-        date_obj = datetime.strptime(date_str, "%Y%m%d")
-        epi_week = Week.fromdate(date_obj)
-        year_week = f"{epi_week.year}/{epi_week.week:02d}"
-        row = {"codigo_ibge": ibge_code, "municipio": name, "ano_semana": year_week}
-        for param in PARAMETERS:
-            row[param] = data.get(param, {}).get(date_str)
-        records.append(row)
-    df = pd.DataFrame(records)
-    if not df.empty:
-        df = df.astype({"codigo_ibge": "int32", "T2M": "float32", "T2M_MAX": "float32", "T2M_MIN": "float32", "PRECTOTCORR": "float32", "RH2M": "float32", "ALLSKY_SFC_SW_DWN": "float32"})
+def epiweeks_of(dates):
+    # Semana epidemiológica (MMWR) vetorizada: semanas de domingo a sábado, e a semana
+    # pertence ao ano da sua quarta-feira (equivale a Week.fromdate, sem laço em Python)
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    weekday = (dates.astype("int64") + 4) % 7  # 1970-01-01 foi quinta-feira; domingo = 0
+    wednesday = dates - weekday + 3
+    year = wednesday.astype("datetime64[Y]")
+    week = (wednesday - year.astype("datetime64[D]")).astype("int64") // 7 + 1
+    return (year.astype("int64") + 1970).astype("int16"), week.astype("int16")
+
+def api_data_to_df(data):
+    # Resposta diária do POWER -> DataFrame coluna a coluna (uma linha por dia)
+    keys = list(data.get(PARAMETERS[0], {}).keys())
+    if not keys:
+        return pd.DataFrame()
+    df = pd.DataFrame({"data": pd.to_datetime(pd.Index(keys), format="%Y%m%d")})
+    for param in PARAMETERS:
+        df[param] = pd.Series(data.get(param, {}), dtype="float64").reindex(keys).to_numpy(dtype="float32")
     return df
 
-def aggregate_weekly(df):
+def add_epiweeks(df):
+    ano, semana = epiweeks_of(df["data"].to_numpy())
+    return df.assign(ano=ano, semana=semana)
+
+def raw_cell_dir(cell):
+    return RAW_DAILY_DIR / f"celula_{'_'.join(map(str, cell))}"
+
+def load_raw_cell(cell):
+    # Junta as partes da célula; em datas repetidas vale a parte gravada por último
+    parts = sorted(raw_cell_dir(cell).glob("*.parquet"))
+    if not parts:
+        return pd.DataFrame()
+    df = pd.concat([pd.read_parquet(p, engine='fastparquet') for p in parts], ignore_index=True)
+    return df.drop_duplicates(subset=["data"], keep="last").sort_values("data").reset_index(drop=True)
+
+def append_raw_cell(cell, daily):
+    if daily.empty:
+        return
+    folder = raw_cell_dir(cell)
+    folder.mkdir(parents=True, exist_ok=True)
+    first, last = daily["data"].min(), daily["data"].max()
+    name = f"{datetime.now():%Y%m%d%H%M%S%f}_{first:%Y%m%d}_{last:%Y%m%d}.parquet"
+    tmp = folder / f"{name}.tmp"
+    daily.to_parquet(tmp, index=False, engine='fastparquet')
+    tmp.replace(folder / name)
+    compact_raw_cell(cell, RAW_MAX_PARTS)
+
+def compact_raw_cell(cell, max_parts=1):
+    # Junta as partes da célula num único ficheiro quando passam de max_parts
+    folder = raw_cell_dir(cell)
+    parts = sorted(folder.glob("*.parquet"))
+    if len(parts) <= max_parts:
+        return
+    merged = load_raw_cell(cell)
+    first, last = merged["data"].min(), merged["data"].max()
+    name = f"{datetime.now():%Y%m%d%H%M%S%f}_{first:%Y%m%d}_{last:%Y%m%d}.parquet"
+    tmp = folder / f"{name}.tmp"
+    merged.to_parquet(tmp, index=False, engine='fastparquet')
+    tmp.replace(folder / name)
+    for part in parts:
+        part.unlink()
+
+def members_frame(members, starts):
+    return pd.DataFrame({
+        "codigo_ibge": [m["codigo_ibge"] for m in members],
+        "municipio": [m["nome"] for m in members],
+        # Semana inicial de cada município como inteiro AAAASS, para filtrar sem laço
+        "inicio": [starts[m["codigo_ibge"]].year * 100 + starts[m["codigo_ibge"]].week for m in members],
+    })
+
+def aggregate_weekly(df, keys):
     if df.empty: return df
-    return df.groupby(["codigo_ibge", "municipio", "ano_semana"]).agg({
+    return df.groupby(keys, sort=False).agg({
         "T2M": "mean", "T2M_MAX": "mean", "T2M_MIN": "mean", "RH2M": "mean",
         "ALLSKY_SFC_SW_DWN": "mean", "PRECTOTCORR": "sum"
     }).reset_index()
 
-async def process_municipio(municipio, client, rate_limiter, semaphore, idx, total, df_existing):
+def build_weekly(fetched):
+    """Agrega os dias de todas as células num único groupby e distribui por município.
+
+    `fetched` é uma lista de (diário da célula, municípios pendentes com a
+    semana inicial de cada um).
+    """
+    daily = add_epiweeks(pd.concat([d.assign(celula=i) for i, (d, _) in enumerate(fetched)], ignore_index=True))
+    members = pd.concat([m.assign(celula=i) for i, (_, m) in enumerate(fetched)], ignore_index=True)
+    weekly = aggregate_weekly(daily.drop(columns=["data"]), ["celula", "ano", "semana"])
+
+    df = members.merge(weekly, on="celula", how="inner")
+    df = df[df["ano"].astype("int32") * 100 + df["semana"] >= df["inicio"]]
+    df = df.drop(columns=["celula", "inicio"]).astype({"codigo_ibge": "int32"})
+    # "ano_semana" continua no ficheiro para quem ainda o consome
+    df.insert(2, "ano_semana", df["ano"].astype(str) + "/" + df["semana"].astype(str).str.zfill(2))
+    return df.reset_index(drop=True)
+
+async def process_cell(cell, members, client, rate_limiter, semaphore, idx, total, last_weeks, done=frozenset()):
     async with semaphore:
-        codigo_ibge = municipio["codigo_ibge"]
-        name = municipio["nome"]
-        last_week = get_last_week_for_municipio(df_existing, codigo_ibge)
-        start_week = Week(2014, 1) if last_week is None else last_week + 1
-        
-        if start_week > UPDATE_UNTIL_WEEK:
-            logging.info(f"[{idx}/{total}] {name} já está atualizado. A saltar.")
-            return None 
-
-        start_date_str = start_week.startdate().strftime("%Y%m%d")
-        end_date_str = UPDATE_UNTIL_WEEK.enddate().strftime("%Y%m%d")
-
-        logging.info(f"[{idx}/{total}] A obter dados para {name} (semanas {start_week} a {UPDATE_UNTIL_WEEK})")
-        data = await fetch_data(client, rate_limiter, municipio["latitude"], municipio["longitude"], start_date_str, end_date_str)
-
-        if data:
-            df_new = api_data_to_df(name, codigo_ibge, data)
-            df_weekly = aggregate_weekly(df_new)
-            logging.info(f"[{idx}/{total}] {name} atualizado com sucesso.")
-            return df_weekly 
-        else:
-            logging.warning(f"[{idx}/{total}] Falha ao obter dados para {name}")
+        starts = {}
+        for m in members:
+            if m["codigo_ibge"] in done:
+                continue
+            last_week = last_weeks.get(m["codigo_ibge"])
+            start_week = SERIES_START_WEEK if last_week is None else last_week + 1
+            if start_week <= UPDATE_UNTIL_WEEK:
+                starts[m["codigo_ibge"]] = start_week
+        pending = [m for m in members if m["codigo_ibge"] in starts]
+
+        if not pending:
+            logging.info(f"[{idx}/{total}] Célula {cell} ({len(members)} municípios) já está atualizada. A saltar.")
             return None
 
-async def main():
+        # Um único pedido por célula, desde a semana mais antiga em falta entre os municípios dela
+        start_week = min(starts.values())
+        start_day = pd.Timestamp(start_week.startdate())
+        end_day = pd.Timestamp(UPDATE_UNTIL_WEEK.enddate())
+
+        # Dias já guardados no cache diário não são pedidos de novo
+        raw = await asyncio.to_thread(load_raw_cell, cell)
+        fetch_start = start_day
+        if not raw.empty and raw["data"].min() <= start_day:
+            fetch_start = max(start_day, raw["data"].max() + pd.Timedelta(days=1))
+
+        if fetch_start <= end_day:
+            lat, lon = cell_center(cell)
+            logging.info(f"[{idx}/{total}] A obter dados da célula {cell} para {len(pending)} municípios ({fetch_start:%Y-%m-%d} a {end_day:%Y-%m-%d})")
+            data = await fetch_data(client, rate_limiter, lat, lon, f"{fetch_start:%Y%m%d}", f"{end_day:%Y%m%d}")
+            if not data:
+                logging.warning(f"[{idx}/{total}] Falha ao obter dados da célula {cell} ({', '.join(m['nome'] for m in pending)})")
+                return None
+            new = api_data_to_df(data)
+            await asyncio.to_thread(append_raw_cell, cell, new)
+            raw = pd.concat([raw, new], ignore_index=True).drop_duplicates(subset=["data"], keep="last")
+        else:
+            logging.info(f"[{idx}/{total}] Célula {cell}: semanas {start_week} a {UPDATE_UNTIL_WEEK} lidas do cache diário.")
+
+        daily = raw[(raw["data"] >= start_day) & (raw["data"] <= end_day)]
+        logging.info(f"[{idx}/{total}] Célula {cell} atualizada com sucesso ({len(pending)} municípios).")
+        return daily, members_frame(pending, starts)
+
+async def backfill_raw_cell(cell, members, client, rate_limiter, semaphore, idx, total):
+    # Completa o cache diário da célula desde o início da série até ao primeiro dia já guardado
+    async with semaphore:
+        raw = await asyncio.to_thread(load_raw_cell, cell)
+        start_day = pd.Timestamp(SERIES_START_WEEK.startdate())
+        end_day = pd.Timestamp(UPDATE_UNTIL_WEEK.enddate())
+        if not raw.empty:
+            end_day = raw["data"].min() - pd.Timedelta(days=1)
+        if start_day > end_day:
+            return raw
+
+        lat, lon = cell_center(cell)
+        logging.info(f"[{idx}/{total}] A completar o cache diário da célula {cell} ({start_day:%Y-%m-%d} a {end_day:%Y-%m-%d})")
+        data = await fetch_data(client, rate_limiter, lat, lon, f"{start_day:%Y%m%d}", f"{end_day:%Y%m%d}")
+        if not data:
+            logging.warning(f"[{idx}/{total}] Falha ao completar o cache diário da célula {cell} ({', '.join(m['nome'] for m in members)})")
+            return raw
+        new = api_data_to_df(data)
+        await asyncio.to_thread(append_raw_cell, cell, new)
+        return pd.concat([new, raw], ignore_index=True).drop_duplicates(subset=["data"], keep="last")
+
+def raw_coverage(raw):
+    """Primeira e última semanas completas do cache diário de uma célula.
+
+    Devolve None se o cache estiver vazio, tiver dias em falta ou não começar
+    no início da série.
+    """
+    if raw.empty:
+        return None
+    first_day, last_day = raw["data"].min(), raw["data"].max()
+    if raw["data"].nunique() != (last_day - first_day).days + 1:
+        return None
+    first = Week.fromdate(first_day.date())
+    if pd.Timestamp(first.startdate()) != first_day:
+        first += 1
+    last = Week.fromdate(last_day.date())
+    if pd.Timestamp(last.enddate()) != last_day:
+        last -= 1
+    if first != SERIES_START_WEEK or last < first:
+        return None
+    return first, last
+
+async def reaggregate_from_raw(municipios, client, rate_limiter):
+    """Refaz as semanas a partir do cache diário.
+
+    Células sem cache são primeiro completadas desde o início da série. Se
+    alguma célula continuar sem cobertura completa, nada é reagregado e a
+    função devolve um DataFrame vazio com a lista dessas células.
+    """
+    cells = group_by_cell(municipios)
+    semaphore = asyncio.Semaphore(CONCURRENT_TASKS)
+    raws = await asyncio.gather(*[
+        backfill_raw_cell(cell, members, client, rate_limiter, semaphore, i+1, len(cells))
+        for i, (cell, members) in enumerate(cells.items())
+    ])
+
+    fetched, incomplete = [], []
+    for (cell, members), raw in zip(cells.items(), raws):
+        # As execuções semanais só acrescentam partes; a reagregação é quando o cache é compactado
+        await asyncio.to_thread(compact_raw_cell, cell)
+        coverage = raw_coverage(raw)
+        if coverage is None:
+            incomplete.append(cell)
+            continue
+        first, last = coverage
+        daily = raw[(raw["data"] >= pd.Timestamp(first.startdate())) & (raw["data"] <= pd.Timestamp(last.enddate()))]
+        fetched.append((daily, members_frame(members, {m["codigo_ibge"]: first for m in members})))
+    if incomplete or not fetched:
+        return pd.DataFrame(), incomplete
+    return build_weekly(fetched), incomplete
+
+async def main(reaggregate=False):
     try:
         async with aiofiles.open(INPUT_FILE, "r", encoding="utf-8-sig") as f:
             municipios = json.loads(await f.read())
@@ -131,39 +526,76 @@ async def main():
     unique = {m["codigo_ibge"]: m for m in municipios}
     municipios = list(unique.values())
 
+    if reaggregate:
+        logging.info(f"A reagregar as semanas a partir do cache diário em {RAW_DAILY_DIR}...")
+        rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, burst=RATE_LIMIT_BURST)
+        async with httpx.AsyncClient() as client:
+            df_weekly, incomplete = await reaggregate_from_raw(municipios, client, rate_limiter)
+        if incomplete:
+            logging.error(f"Cache diário incompleto em {len(incomplete)} células ({', '.join(map(str, incomplete[:10]))}"
+                          f"{', ...' if len(incomplete) > 10 else ''}). Reagregação cancelada; as partições não foram modificadas.")
+            return
+        if df_weekly.empty:
+            logging.warning("Cache diário vazio. As partições não foram modificadas.")
+            return
+        # Só as semanas cobertas pelo cache são substituídas; o resto das partições fica como está
+        await asyncio.to_thread(migrate_legacy_file)
+        touched = await asyncio.to_thread(upsert_weekly, df_weekly)
+        logging.info(f"✅ {len(df_weekly)} semanas reagregadas em {OUTPUT_DIR} (partições {', '.join(map(str, touched))}).")
+        return
+
+    cells = group_by_cell(municipios)
+    logging.info(f"{len(municipios)} municípios agrupados em {len(cells)} células da grade do POWER.")
+
     df_existing = pd.DataFrame()
-    if await aiofiles.os.path.exists(OUTPUT_FILE):
-        try:
-            df_existing = pd.read_parquet(OUTPUT_FILE, engine='fastparquet')
-        except Exception as e:
-            logging.error(f"Não foi possível ler o ficheiro de dados climáticos existente: {e}")
+    try:
+        await asyncio.to_thread(migrate_legacy_file)
+        df_existing = await asyncio.to_thread(read_week_index)
+    except Exception as e:
+        logging.error(f"Não foi possível ler os dados climáticos existentes: {e}")
+    last_weeks = build_resume_index(df_existing)
             
-    rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE)
+    rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, burst=RATE_LIMIT_BURST)
     semaphore = asyncio.Semaphore(CONCURRENT_TASKS)
     
+    checkpoint = Checkpoint(CHECKPOINT_DIR, UPDATE_UNTIL_WEEK)
+    if checkpoint.done:
+        logging.info(f"A retomar execução interrompida: {len(checkpoint.done)} municípios já concluídos em {len(checkpoint.fragments)} fragmentos.")
+
+    def flush(batch):
+        codes = pd.concat([m["codigo_ibge"] for _, m in batch], ignore_index=True)
+        checkpoint.save(build_weekly(batch), codes)
+
+    batch = []
     async with httpx.AsyncClient() as client:
-        tasks = [process_municipio(m, client, rate_limiter, semaphore, i+1, len(municipios), df_existing) for i, m in enumerate(municipios)]
-        results = await asyncio.gather(*tasks)
+        tasks = [process_cell(cell, members, client, rate_limiter, semaphore, i+1, len(cells), last_weeks, frozenset(checkpoint.done)) for i, (cell, members) in enumerate(cells.items())]
+        # Os resultados vão para o checkpoint à medida que chegam, em lotes de células
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            if result is not None and not result[0].empty:
+                batch.append(result)
+            if len(batch) >= CHECKPOINT_EVERY:
+                await asyncio.to_thread(flush, batch)
+                batch = []
+    if batch:
+        await asyncio.to_thread(flush, batch)
 
-    new_data_frames = [df for df in results if df is not None and not df.empty]
-    
-    if not new_data_frames:
+    df_new_data = checkpoint.load()
+    if df_new_data.empty:
         logging.info("Nenhum dado novo para adicionar. O ficheiro não foi modificado.")
     else:
-        logging.info(f"A processar dados de {len(new_data_frames)} municípios.")
-        df_new_data = pd.concat(new_data_frames, ignore_index=True)
-        
-        df_combined = pd.concat([df_existing, df_new_data], ignore_index=True)
-        
-        df_combined.drop_duplicates(subset=['codigo_ibge', 'ano_semana'], keep='last', inplace=True)
-        
-        df_combined = df_combined.sort_values(by=["codigo_ibge", "ano_semana"])
-        
-        logging.info(f"A salvar o ficheiro Parquet atualizado em {OUTPUT_FILE}...")
-        df_combined.to_parquet(OUTPUT_FILE, index=False, engine='fastparquet')
-        logging.info("Ficheiro Parquet salvo com sucesso.")
+        logging.info(f"A juntar {len(checkpoint.fragments)} fragmentos do checkpoint.")
+        logging.info(f"A atualizar as partições anuais em {OUTPUT_DIR}...")
+        touched = upsert_weekly(df_new_data)
+        logging.info(f"Partições atualizadas: {', '.join(map(str, touched))}.")
+    checkpoint.clear()
+    logging.info(f"Estatísticas do limitador: {rate_limiter.stats()}")
 
     logging.info("✅ Recolha de dados climáticos concluída.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Recolhe os dados climáticos semanais do NASA POWER.")
+    parser.add_argument("--reagregar", action="store_true",
+                        help="Refaz as partições semanais a partir do cache diário; só pede à API os dias em falta antes do início do cache")
+    args = parser.parse_args()
+    asyncio.run(main(reaggregate=args.reagregar))
@@ -11,7 +11,8 @@ import numpy as np
 # --- CAMINHOS ROBUSTOS ---
 SCRIPT_DIR = Path(__file__).resolve().parent
 DATA_PREV_PATH = SCRIPT_DIR / "../casos"
-CLIMATE_PATH = SCRIPT_DIR / "../dadosClimaticos.parquet"
+CLIMATE_PATH = SCRIPT_DIR / "../dadosClimaticos"
+CLIMATE_LEGACY_PATH = SCRIPT_DIR / "../dadosClimaticos.parquet"
 STATES_JSON_PATH = SCRIPT_DIR / "../municipios/estados.json"
 MUNICIPIOS_JSON_PATH = SCRIPT_DIR / "../municipios/municipios.json"
 OUTPUT_PATH = SCRIPT_DIR / "../inference_data.parquet"
@@ -86,11 +87,19 @@ def add_geo_info(df, states_dict, municipios_list):
     df.drop(columns=["codigo_ibge_6", "uf_code"], inplace=True)
     return df
 
-def load_climate_data(path):
-    if not path.exists():
+def load_climate_data(path, legacy_path=None):
+    # Dados climáticos particionados por ano (pasta) ou, se ainda não houver, o ficheiro único antigo
+    if path.is_dir() and any(path.glob("ano_*.parquet")):
+        parts = sorted(path.glob("ano_*.parquet"))
+        df = pd.concat([pd.read_parquet(p, engine='fastparquet') for p in parts], ignore_index=True)
+    elif legacy_path is not None and legacy_path.exists():
+        df = pd.read_parquet(legacy_path, engine='fastparquet')
+    else:
         raise FileNotFoundError(f"Ficheiro de clima não encontrado em {path}")
-    df = pd.read_parquet(path, engine='fastparquet')
-    df[["ano", "semana"]] = df["ano_semana"].str.extract(r"(\d{4})/(\d{2})").astype(int)
+    if {"ano", "semana"} <= set(df.columns):
+        df[["ano", "semana"]] = df[["ano", "semana"]].astype(int)
+    else:
+        df[["ano", "semana"]] = df["ano_semana"].str.extract(r"(\d{4})/(\d{2})").astype(int)
     return df
 
 # ✅ --- FUNÇÃO TOTALMENTE REESCRITA PARA MAIOR ROBUSTEZ E CLAREZA ---
@@ -170,7 +179,7 @@ def main():
         return
         
     df_prev = add_geo_info(df_prev, states_dict, municipios_list)
-    df_climate = load_climate_data(CLIMATE_PATH)
+    df_climate = load_climate_data(CLIMATE_PATH, CLIMATE_LEGACY_PATH)
 
     df_final = create_inference_df(df_prev, df_climate, municipios_list, 
                                    limit_year=LIMIT_YEAR, 
@@ -1,14 +1,21 @@
 # uvicorn app:app --reload
 import os
+import tempfile
+import zipfile
+from contextlib import ExitStack
+from functools import partial
 import uvicorn
-from fastapi import Body, FastAPI, UploadFile, File, Response
+from fastapi import Body, FastAPI, Request, UploadFile, File, Response
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 import traceback
 import numpy as np
 import json
 
-from detect import DengueDetector
+from detect import DengueDetector, sniff_image_format, validate_risk_grid
+from detect_jobs import DetectionJobManager
+from detect_video import VideoDetector
 from municipal_predictor import DenguePredictor
 from state_predictor import StatePredictor
 
@@ -24,25 +31,81 @@ def default_json_serializer(obj):
 
 
 detector: DengueDetector | None = None
+job_manager: DetectionJobManager | None = None
+video_detector: VideoDetector | None = None
 predictor: DenguePredictor | None = None
 state_predictor: StatePredictor | None = None
 
 # Se api irá utilizar datasets baixados do hugging face ou os locais
 ONLINE: bool = True
 
+# Tamanho máximo do lote de tiles do detector e espera máxima (ms) por tiles de outras requisições
+DETECT_BATCH_TILES: int = 8
+DETECT_BATCH_WAIT_MS: float = 10.0
+# Pula tiles uniformes (sem conteúdo) por padrão; pode ser sobrescrito por requisição
+DETECT_SKIP_UNIFORM_TILES: bool = False
+# Preset de detecção usado quando a requisição não informa um ("realtime", "balanced", "thorough")
+# e ajustes por implantação, ex.: {"realtime": {"max_side": 1536}}
+DETECT_DEFAULT_PRESET: str = "balanced"
+DETECT_PRESET_OVERRIDES: dict = {}
+# Backend de inferência do detector: "torch", "onnx" ou "openvino" (precisão "fp32", "fp16" ou "int8")
+DETECT_BACKEND: str = "torch"
+DETECT_PRECISION: str = "fp32"
+# int8 (openvino) só com dataset de calibração próprio: YAML do ultralytics com imagens aéreas
+DETECT_INT8_CALIBRATION_DATA: str | None = None
+# Réplicas do modelo de detecção rodando em paralelo (threads) e threads intra-op por réplica
+# (None = núcleos disponíveis divididos entre as réplicas). Em onnx/openvino o limite vale por
+# sessão; no torch é um ajuste único do processo, compartilhado por todas as réplicas
+DETECT_REPLICAS: int = 1
+DETECT_INTRA_OP_THREADS: int | None = None
+# Tamanho máximo (bytes) de cada imagem enviada (em /detect/ e em cada arquivo de /detect/batch)
+# e do corpo inteiro de /detect/batch e /detect/video; corpos maiores são recusados pelo
+# Content-Length antes de serem lidos
+DETECT_MAX_UPLOAD_BYTES: int = 50 * 1024 * 1024
+DETECT_MAX_BATCH_UPLOAD_BYTES: int = 500 * 1024 * 1024
+DETECT_MAX_VIDEO_UPLOAD_BYTES: int = 2 * 1024 * 1024 * 1024
+# Limites para .zip em /detect/batch, pelo tamanho descompactado declarado em cada entrada:
+# cada imagem até DETECT_MAX_UPLOAD_BYTES, soma até DETECT_MAX_ZIP_TOTAL_BYTES
+DETECT_MAX_ZIP_ENTRIES: int = 500
+DETECT_MAX_ZIP_TOTAL_BYTES: int = 500 * 1024 * 1024
+# Cache de resultados de detecção por hash do conteúdo da imagem + configuração do detector
+DETECT_CACHE_ENABLED: bool = True
+DETECT_CACHE_DIR: str = os.path.join(tempfile.gettempdir(), "previdengue_detect_cache")
+# Pasta onde os uploads dos jobs assíncronos de detecção são gravados até serem processados
+DETECT_JOBS_DIR: str = os.path.join(tempfile.gettempdir(), "previdengue_detect_jobs")
+# Vídeo de drone: quadros amostrados por segundo, duração (s) de cada segmento do resumo e
+# distância máxima de Hamming (dHash 64 bits) para considerar um quadro repetido
+DETECT_VIDEO_SAMPLE_FPS: float = 1.0
+DETECT_VIDEO_SEGMENT_SECONDS: float = 10.0
+DETECT_VIDEO_HASH_THRESHOLD: int = 4
+
 app = FastAPI()
 
 
 @app.on_event("startup")
 async def startup_event():
-    global detector, predictor, state_predictor
+    global detector, job_manager, video_detector, predictor, state_predictor
     print("Executando evento de startup: Carregando os módulos de IA...")
 
     offline_flag = (not ONLINE)
     local_city_inf = None
     local_state_inf = None
 
-    detector = DengueDetector()
+    detector = DengueDetector(batch_tiles=DETECT_BATCH_TILES, batch_wait_ms=DETECT_BATCH_WAIT_MS,
+                              skip_uniform_tiles=DETECT_SKIP_UNIFORM_TILES,
+                              cache_dir=DETECT_CACHE_DIR, cache_enabled=DETECT_CACHE_ENABLED,
+                              default_preset=DETECT_DEFAULT_PRESET, presets=DETECT_PRESET_OVERRIDES,
+                              backend=DETECT_BACKEND, precision=DETECT_PRECISION,
+                              calibration_data=DETECT_INT8_CALIBRATION_DATA,
+                              replicas=DETECT_REPLICAS, intra_op_threads=DETECT_INTRA_OP_THREADS)
+    job_manager = DetectionJobManager(detector, DETECT_JOBS_DIR)
+    try:
+        video_detector = VideoDetector(detector, sample_fps=DETECT_VIDEO_SAMPLE_FPS,
+                                       segment_seconds=DETECT_VIDEO_SEGMENT_SECONDS,
+                                       hash_threshold=DETECT_VIDEO_HASH_THRESHOLD)
+    except Exception as e:
+        print("[WARN] Detecção em vídeo indisponível:", str(e))
+        video_detector = None
     try:
         predictor = DenguePredictor(
             offline=offline_flag,
@@ -65,6 +128,31 @@ async def startup_event():
     print("Módulos de IA carregados com sucesso. API pronta. Modo:", "online" if ONLINE else "offline")
 
 
+def _mb(n):
+    return n // (1024 * 1024)
+
+
+DETECT_BODY_LIMITS = {
+    "/detect/": DETECT_MAX_UPLOAD_BYTES,
+    "/detect/batch": DETECT_MAX_BATCH_UPLOAD_BYTES,
+    "/detect/video": DETECT_MAX_VIDEO_UPLOAD_BYTES,
+}
+
+
+# Registrado antes do CORS para que o CORSMiddleware (externo) também envolva o 413;
+# sem os cabeçalhos CORS o front-end veria só uma falha de rede
+@app.middleware("http")
+async def limit_detect_upload_size(request: Request, call_next):
+    limit = DETECT_BODY_LIMITS.get(request.url.path) if request.method == "POST" else None
+    if limit is not None:
+        length = request.headers.get("content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            return JSONResponse(status_code=413, content={
+                "error": f"Envio maior que o limite de {_mb(limit)} MB."
+            })
+    return await call_next(request)
+
+
 # --- CORS ---
 origins = ["https://previdengue.vercel.app", "http://localhost:3000", "*"]
 app.add_middleware(
@@ -86,13 +174,47 @@ def health_check():
     }
 
 
+@app.get("/detect/presets")
+def detect_presets():
+    if detector is None:
+        return JSONResponse(status_code=503, content={"error": "Detector ainda não foi inicializado."})
+    return {
+        "default": detector.default_preset,
+        "presets": detector.presets,
+        "backend": detector.backend,
+        "precision": detector.precision,
+        "replicas": detector.replicas,
+    }
+
+
 @app.post("/detect/")
-async def detect(file: UploadFile = File(...)):
+async def detect(file: UploadFile = File(...), skip_uniform: bool | None = None,
+                 preset: str | None = None, fast: bool = True,
+                 risk_grid: int | None = None, risk_format: str = "array"):
     if detector is None:
         return JSONResponse(status_code=503, content={"error": "Detector ainda não foi inicializado."})
     try:
-        content = await file.read()
-        result = detector.detect_image(content)
+        validate_risk_grid(risk_grid, risk_format)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    try:
+        # O upload já está num arquivo temporário (spooled, vai para o disco acima de 1 MB);
+        # a imagem é decodificada direto dele, sem copiar o corpo inteiro para a memória
+        fh = file.file
+        size = fh.seek(0, os.SEEK_END)
+        fh.seek(0)
+        if size > DETECT_MAX_UPLOAD_BYTES:
+            return JSONResponse(status_code=413, content={
+                "error": f"Arquivo maior que o limite de {_mb(DETECT_MAX_UPLOAD_BYTES)} MB."
+            })
+        head = fh.read(16)
+        fh.seek(0)
+        if sniff_image_format(head) is None:
+            return JSONResponse(status_code=415, content={"error": "O arquivo enviado não é uma imagem suportada."})
+        # Roda fora do event loop para que várias requisições alimentem o mesmo lote de tiles
+        result = await run_in_threadpool(detector.detect_image, fh, fast=fast,
+                                         skip_uniform=skip_uniform, preset=preset,
+                                         risk_grid=risk_grid, risk_format=risk_format)
         return JSONResponse(content=result)
     except Exception as e:
         tb_str = traceback.format_exc()
@@ -100,6 +222,138 @@ async def detect(file: UploadFile = File(...)):
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp", ".webp")
+
+
+def _batch_images(files, stack):
+    # Lista (nome, origem) das imagens do envio; entradas de .zip ficam como leitura adiada,
+    # feita pelo detector só quando a imagem entra no processamento.
+    # Devolve (imagens, erro); erro é a mensagem para um 413.
+    images = []
+    for upload in files:
+        name = upload.filename or f"imagem_{len(images) + 1}"
+        if name.lower().endswith(".zip") or upload.content_type in ("application/zip", "application/x-zip-compressed"):
+            zf = stack.enter_context(zipfile.ZipFile(upload.file))
+            entries = [
+                info for info in zf.infolist()
+                if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+                and info.filename.lower().endswith(IMAGE_EXTENSIONS)
+            ]
+            if len(entries) > DETECT_MAX_ZIP_ENTRIES:
+                return None, f"{name}: mais de {DETECT_MAX_ZIP_ENTRIES} imagens no arquivo .zip."
+            if any(info.file_size > DETECT_MAX_UPLOAD_BYTES for info in entries):
+                return None, f"{name}: imagem maior que o limite de {_mb(DETECT_MAX_UPLOAD_BYTES)} MB."
+            if sum(info.file_size for info in entries) > DETECT_MAX_ZIP_TOTAL_BYTES:
+                return None, f"{name}: conteúdo descompactado maior que {_mb(DETECT_MAX_ZIP_TOTAL_BYTES)} MB."
+            # zipfile não descompacta além do file_size declarado, então os limites acima valem
+            images.extend((info.filename, partial(zf.read, info)) for info in entries)
+        else:
+            # Arquivo temporário do upload, decodificado direto do disco
+            if upload.file.seek(0, os.SEEK_END) > DETECT_MAX_UPLOAD_BYTES:
+                return None, f"{name}: arquivo maior que o limite de {_mb(DETECT_MAX_UPLOAD_BYTES)} MB."
+            upload.file.seek(0)
+            images.append((name, upload.file))
+    return images, None
+
+
+def _detect_batch(files, **kwargs):
+    with ExitStack() as stack:
+        images, error = _batch_images(files, stack)
+        if error:
+            return None, error
+        if not images:
+            raise ValueError("Nenhuma imagem encontrada no envio.")
+        return detector.detect_images(images, **kwargs), None
+
+
+@app.post("/detect/batch")
+async def detect_batch(files: list[UploadFile] = File(...), skip_uniform: bool | None = None,
+                       preset: str | None = None, fast: bool = True):
+    if detector is None:
+        return JSONResponse(status_code=503, content={"error": "Detector ainda não foi inicializado."})
+    try:
+        # Leitura dos .zip e detecção fora do event loop
+        result, error = await run_in_threadpool(_detect_batch, files, fast=fast,
+                                                skip_uniform=skip_uniform, preset=preset)
+        if error:
+            return JSONResponse(status_code=413, content={"error": error})
+        json_content = json.dumps(result, default=default_json_serializer)
+        return Response(content=json_content, media_type="application/json")
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        print(tb_str)
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+@app.post("/detect/jobs")
+async def create_detect_job(file: UploadFile = File(...), skip_uniform: bool | None = None,
+                            preset: str | None = None, risk_grid: int | None = None,
+                            risk_format: str = "array"):
+    if job_manager is None:
+        return JSONResponse(status_code=503, content={"error": "Detector ainda não foi inicializado."})
+    try:
+        validate_risk_grid(risk_grid, risk_format)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    path = job_manager.new_upload_path(file.filename)
+    try:
+        # Grava o upload em disco em blocos, sem manter o arquivo inteiro em memória
+        with open(path, "wb") as fh:
+            while chunk := await file.read(1024 * 1024):
+                fh.write(chunk)
+        job_id = job_manager.submit(path, filename=file.filename, skip_uniform=skip_uniform, preset=preset,
+                                    risk_grid=risk_grid, risk_format=risk_format)
+        return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        print(tb_str)
+        path.unlink(missing_ok=True)
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+@app.post("/detect/video")
+async def detect_video(file: UploadFile = File(...), skip_uniform: bool | None = None,
+                       preset: str | None = None, fast: bool = True,
+                       sample_fps: float | None = None, segment_seconds: float | None = None):
+    if video_detector is None:
+        return JSONResponse(status_code=503, content={"error": "Detecção em vídeo não está disponível."})
+    suffix = os.path.splitext(file.filename or "")[1].lower() or ".mp4"
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=DETECT_JOBS_DIR)
+    try:
+        # O decodificador lê o vídeo do disco em fluxo; o upload é gravado em blocos
+        # (o Content-Length já foi checado, mas um corpo sem ele também tem de respeitar o limite)
+        written = 0
+        with os.fdopen(fd, "wb") as fh:
+            while chunk := await file.read(1024 * 1024):
+                written += len(chunk)
+                if written > DETECT_MAX_VIDEO_UPLOAD_BYTES:
+                    return JSONResponse(status_code=413, content={
+                        "error": f"Vídeo maior que o limite de {_mb(DETECT_MAX_VIDEO_UPLOAD_BYTES)} MB."
+                    })
+                fh.write(chunk)
+        result = await run_in_threadpool(video_detector.detect, path, skip_uniform=skip_uniform,
+                                         preset=preset, fast=fast, sample_fps=sample_fps,
+                                         segment_seconds=segment_seconds)
+        json_content = json.dumps(result, default=default_json_serializer)
+        return Response(content=json_content, media_type="application/json")
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        print(tb_str)
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    finally:
+        os.unlink(path)
+
+
+@app.get("/detect/jobs/{job_id}")
+async def get_detect_job(job_id: str):
+    if job_manager is None:
+        return JSONResponse(status_code=503, content={"error": "Detector ainda não foi inicializado."})
+    status = job_manager.get(job_id)
+    if status is None:
+        return JSONResponse(status_code=404, content={"error": f"Job '{job_id}' não encontrado."})
+    return JSONResponse(content=status)
+
+
 @app.post("/predict/")
 async def predict_dengue_route(payload: dict = Body(...)):
     if predictor is None:
@@ -125,6 +379,131 @@ async def predict_dengue_route(payload: dict = Body(...)):
         })
 
 
+@app.post("/predict/group/")
+async def predict_dengue_group_route(payload: dict = Body(...)):
+    if predictor is None:
+        return JSONResponse(status_code=503, content={"error": "Preditor ainda não foi inicializado."})
+    try:
+        include_members = bool(payload.get("include_members", False))
+        if payload.get("ibge_codes") is not None:
+            codes = payload.get("ibge_codes")
+            if not isinstance(codes, list) or not codes:
+                raise ValueError("O campo 'ibge_codes' deve ser uma lista não vazia.")
+            result = predictor.predict_group("ibge", ibge_codes=[int(c) for c in codes], include_members=include_members)
+        elif payload.get("regiao"):
+            result = predictor.predict_group("regiao", key=str(payload.get("regiao")), include_members=include_members)
+        elif payload.get("state") or payload.get("uf"):
+            uf = payload.get("state") or payload.get("uf")
+            result = predictor.predict_group("estado", key=str(uf).upper(), include_members=include_members)
+        else:
+            raise ValueError("Informe 'regiao', 'state' (sigla) ou 'ibge_codes'.")
+
+        json_content = json.dumps(result, default=default_json_serializer)
+        return Response(content=json_content, media_type="application/json")
+
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        print(tb_str)
+        return JSONResponse(status_code=500, content={
+            "error": str(e),
+            "traceback": tb_str,
+        })
+
+
+@app.post("/predict/hotspots/")
+async def predict_hotspots_route(payload: dict = Body(default={})):
+    if predictor is None:
+        return JSONResponse(status_code=503, content={"error": "Preditor ainda não foi inicializado."})
+    try:
+        state = payload.get("state") or payload.get("uf")
+        result = predictor.rank_hotspots(
+            metric=str(payload.get("metric", "growth_per_100k")),
+            k=int(payload.get("k", 50)),
+            state=str(state).upper() if state else None,
+            regiao=payload.get("regiao"),
+        )
+
+        json_content = json.dumps(result, default=default_json_serializer)
+        return Response(content=json_content, media_type="application/json")
+
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        print(tb_str)
+        return JSONResponse(status_code=500, content={
+            "error": str(e),
+            "traceback": tb_str,
+        })
+
+
+@app.post("/historic/rollup/")
+async def historic_rollup_route(payload: dict = Body(...)):
+    if predictor is None or predictor.rollup is None:
+        return JSONResponse(status_code=503, content={"error": "Cubo histórico ainda não foi inicializado."})
+    try:
+        level = str(payload.get("level", "brasil")).lower()
+        result = predictor.rollup.query(
+            level,
+            key=payload.get("key"),
+            start=payload.get("start"),
+            end=payload.get("end"),
+            weekly=bool(payload.get("weekly", True)),
+        )
+
+        json_content = json.dumps(result, default=default_json_serializer)
+        return Response(content=json_content, media_type="application/json")
+
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        print(tb_str)
+        return JSONResponse(status_code=500, content={
+            "error": str(e),
+            "traceback": tb_str,
+        })
+
+
+@app.get("/municipios/search/")
+async def search_municipios_route(q: str, limit: int = 10, uf: str | None = None):
+    if predictor is None:
+        return JSONResponse(status_code=503, content={"error": "Preditor ainda não foi inicializado."})
+    return JSONResponse(content={"results": predictor.search_index.search(q, limit=limit, uf=uf)})
+
+
+@app.get("/municipios/nearest/")
+async def nearest_municipios_route(lat: float, lon: float, k: int = 5):
+    if predictor is None:
+        return JSONResponse(status_code=503, content={"error": "Preditor ainda não foi inicializado."})
+    try:
+        return JSONResponse(content={"results": predictor.locator.nearest(lat, lon, k=k)})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+
+@app.get("/predict/nearest/")
+async def predict_nearest_route(lat: float, lon: float):
+    if predictor is None:
+        return JSONResponse(status_code=503, content={"error": "Preditor ainda não foi inicializado."})
+    try:
+        nearest = predictor.locator.nearest(lat, lon, k=1)[0]
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    try:
+        result = predictor.predict(nearest["ibge"])
+        result["nearest"] = nearest
+
+        json_content = json.dumps(result, default=default_json_serializer)
+        return Response(content=json_content, media_type="application/json")
+
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        print(tb_str)
+        return JSONResponse(status_code=500, content={
+            "error": str(e),
+            "traceback": tb_str,
+        })
+
+
 @app.post("/predict/state/")
 async def predict_dengue_state_route(payload: dict = Body(...)):
     global state_predictor
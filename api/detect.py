@@ -1,210 +1,401 @@
-from collections import Counter
+import base64
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import math
+import os
 import numpy as np
 from PIL import Image
 from io import BytesIO
-from ultralytics import YOLO
-
-def _compute_iou(box_a, box_b):
-    ax1, ay1, ax2, ay2 = box_a
-    bx1, by1, bx2, by2 = box_b
-    inter_x1 = max(ax1, bx1)
-    inter_y1 = max(ay1, by1)
-    inter_x2 = min(ax2, bx2)
-    inter_y2 = min(ay2, by2)
-    inter_w = max(0.0, inter_x2 - inter_x1)
-    inter_h = max(0.0, inter_y2 - inter_y1)
-    inter_area = inter_w * inter_h
-    area_a = max(0.0, (ax2 - ax1)) * max(0.0, (ay2 - ay1))
-    area_b = max(0.0, (bx2 - bx1)) * max(0.0, (by2 - by1))
-    union = area_a + area_b - inter_area
-    return inter_area / union if union > 0 else 0.0
-
-def _nms_xyxy(boxes, scores, iou_threshold=0.5):
+
+from detect_backend import load_model, set_intra_op_threads
+from detect_cache import DetectionCache, file_sha256
+from tile_batcher import TileBatcher
+
+def _batched_nms(boxes, scores, classes, iou_threshold=0.5):
+    # NMS por classe numa única chamada: desloca as caixas de cada classe para
+    # uma região disjunta do plano, de modo que classes diferentes nunca se sobrepõem.
     if len(boxes) == 0:
-        return []
-    idxs = np.argsort(scores)[::-1]
+        return np.zeros(0, dtype=int)
+    boxes = np.asarray(boxes, dtype=float)
+    scores = np.asarray(scores, dtype=float)
+    classes = np.asarray(classes, dtype=int)
+
+    offset = boxes.max() - boxes.min() + 1.0
+    areas = np.clip(boxes[:, 2] - boxes[:, 0], 0.0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0.0, None)
+    x1, y1, x2, y2 = (boxes + (classes * offset)[:, None]).T
+
+    order = np.argsort(-scores, kind="stable")
     keep = []
-    while len(idxs) > 0:
-        i = idxs[0]
+    while order.size > 0:
+        i = order[0]
         keep.append(i)
-        if len(idxs) == 1:
-            break
-        rest = idxs[1:]
-        ious = np.array([_compute_iou(boxes[i], boxes[j]) for j in rest])
-        idxs = rest[ious <= iou_threshold]
-    return keep
+        rest = order[1:]
+        inter_w = np.clip(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0.0, None)
+        inter_h = np.clip(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0.0, None)
+        inter = inter_w * inter_h
+        union = areas[i] + areas[rest] - inter
+        iou = np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+        order = rest[iou <= iou_threshold]
+
+    keep = np.array(keep, dtype=int)
+    # Ordem de saída: classe crescente e, dentro da classe, confiança decrescente
+    return keep[np.lexsort((-scores[keep], classes[keep]))]
+
+def _tile_content_score(tile, step=8):
+    # Pontuação barata de conteúdo: desvio padrão da luminância e densidade de bordas
+    # numa versão subamostrada do tile (1 a cada `step` pixels).
+    small = tile[::step, ::step].astype(np.float32)
+    gray = small @ np.array([0.299, 0.587, 0.114], dtype=np.float32) if small.ndim == 3 else small
+    std = float(gray.std())
+    if gray.shape[0] < 2 or gray.shape[1] < 2:
+        return std, 0.0
+    edges = (np.abs(np.diff(gray, axis=0)).mean() + np.abs(np.diff(gray, axis=1)).mean()) / 2.0
+    return std, float(edges)
+
+def _tile_starts(total, size, stride):
+    starts = list(range(0, max(total - size, 0) + 1, stride))
+    if len(starts) == 0:
+        starts = [0]
+    last = max(total - size, 0)
+    if starts[-1] != last:
+        starts.append(last)
+    return starts
+
+def _iter_tiles(img_np, tile_size, overlap):
+    # Gera (x0, y0, tile) com tiles como views do array da imagem, sem cópias
+    height, width = img_np.shape[:2]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    for y0 in _tile_starts(height, tile_size, stride):
+        for x0 in _tile_starts(width, tile_size, stride):
+            tile = img_np[y0:min(y0 + tile_size, height), x0:min(x0 + tile_size, width)]
+            if tile.size == 0:
+                continue
+            yield x0, y0, tile
+
+# Assinaturas (magic bytes) dos formatos de imagem aceitos no upload
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+    (b"BM", "BMP"),
+)
+
+def sniff_image_format(head: bytes):
+    # Identifica o formato pelos primeiros bytes, sem decodificar nada
+    for signature, fmt in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return fmt
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+# Peso de risco por classe (classes desconhecidas valem 1.0)
+CLASS_WEIGHTS = {
+    "piscina_suja": 10.0,
+    "reservatorio_de_agua": 8.0,
+    "pneu": 6.0,
+    "lona": 4.0,
+    "monte_de_lixo": 3.0,
+    "saco_de_lixo": 2.0,
+    "piscina_limpa": 1.0
+}
+
+def _axis_overlap(lo, hi, edges):
+    # Sobreposição (em pixels) de cada intervalo [lo, hi] com cada célula [edges[j], edges[j+1]]
+    return np.clip(np.minimum(hi[:, None], edges[None, 1:]) - np.maximum(lo[:, None], edges[None, :-1]), 0, None)
+
+def _risk_map(boxes, risk, width, height, grid_cells=None):
+    """Score de intensidade e, opcionalmente, grade de risco numa única passada vetorizada.
+
+    `risk` é peso * confiança por caixa. Cada célula soma risco * área de
+    sobreposição / área da imagem * 100, então a grade soma o próprio score
+    (a menos das partes das caixas fora da imagem).
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    risk = np.asarray(risk, dtype=float)
+    total_area = float(width * height)
+    if total_area == 0:
+        return float(risk.sum()), None
+
+    norm = risk * (100.0 / total_area)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    score = float(norm @ areas)
+    if not grid_cells:
+        return score, None
+
+    cell = max(1, math.ceil(max(width, height) / int(grid_cells)))
+    x_edges = np.minimum(np.arange(0, math.ceil(width / cell) + 1) * cell, width).astype(float)
+    y_edges = np.minimum(np.arange(0, math.ceil(height / cell) + 1) * cell, height).astype(float)
+    ox = _axis_overlap(boxes[:, 0], boxes[:, 2], x_edges)
+    oy = _axis_overlap(boxes[:, 1], boxes[:, 3], y_edges)
+    # Área de sobreposição caixa x célula = sobreposição em y * sobreposição em x
+    grid = np.einsum("n,ny,nx->yx", norm, oy, ox)
+    return score, {"cell_size": cell, "values": grid}
+
+# Limite de células no lado maior da grade de risco (256 x 256 já cobre um ortomosaico em detalhe)
+RISK_GRID_MAX_CELLS = 256
+RISK_GRID_FORMATS = ("array", "png")
+
+def validate_risk_grid(grid_cells, fmt="array"):
+    # Chamado antes da inferência para que parâmetros inválidos não custem uma detecção inteira
+    if grid_cells is not None and not 1 <= int(grid_cells) <= RISK_GRID_MAX_CELLS:
+        raise ValueError(f"risk_grid deve estar entre 1 e {RISK_GRID_MAX_CELLS}.")
+    if fmt not in RISK_GRID_FORMATS:
+        raise ValueError(f"Formato de grade '{fmt}' inválido. Opções: {list(RISK_GRID_FORMATS)}")
+
+def _encode_risk_grid(grid, width, height, fmt="array"):
+    values = grid["values"]
+    peak = float(values.max()) if values.size else 0.0
+    out = {
+        "rows": int(values.shape[0]),
+        "cols": int(values.shape[1]),
+        "cell_size": int(grid["cell_size"]),
+        "width": width,
+        "height": height,
+        "max": peak,
+    }
+    if fmt == "png":
+        # PNG em tons de cinza normalizado pelo máximo (0 = sem risco, 255 = célula de maior risco)
+        scaled = np.zeros(values.shape, dtype=np.uint8) if peak <= 0 else np.round(values * (255.0 / peak)).astype(np.uint8)
+        buf = BytesIO()
+        Image.fromarray(scaled, mode="L").save(buf, format="PNG", optimize=True)
+        out["png"] = base64.b64encode(buf.getvalue()).decode("ascii")
+    elif fmt == "array":
+        out["values"] = np.round(values, 6).tolist()
+    else:
+        raise ValueError(f"Formato de grade '{fmt}' inválido. Opções: {list(RISK_GRID_FORMATS)}")
+    return out
+
+# Presets de velocidade/precisão. max_side=None processa na resolução original;
+# imgsz/conf=None usam os padrões do modelo. "balanced" reproduz o comportamento original.
+DETECTION_PRESETS = {
+    "realtime": {"tile_size": 1280, "overlap": 0.1, "max_side": 2048, "imgsz": 640, "conf": 0.35, "iou": 0.5},
+    "balanced": {"tile_size": 1024, "overlap": 0.2, "max_side": 3072, "imgsz": None, "conf": None, "iou": 0.5},
+    "thorough": {"tile_size": 1024, "overlap": 0.3, "max_side": None, "imgsz": 1024, "conf": 0.15, "iou": 0.5},
+}
 
 class DengueDetector:
-    def __init__(self, model_path="./models/detect.pt"):
-        self.model = YOLO(model_path)
+    def __init__(self, model_path="./models/detect.pt", batch_tiles: int = 8, batch_wait_ms: float = 10.0,
+                 skip_uniform_tiles: bool = False, cache_dir: str | None = None, cache_enabled: bool = True,
+                 default_preset: str = "balanced", presets: dict | None = None,
+                 backend: str = "torch", precision: str = "fp32", calibration_data: str | None = None,
+                 replicas: int = 1, intra_op_threads: int | None = None):
+        # backend "onnx"/"openvino" exporta o .pt uma vez (cache ao lado do modelo) e roda pelo runtime
+        self.model, self.model_file = load_model(model_path, backend=backend, precision=precision,
+                                                 calibration_data=calibration_data)
+        self.backend = backend
+        self.precision = precision
         self.names = self.model.names
         
-        self.tile_size = 1024
-        self.default_overlap = 0.2 
-        self.fast_max_side = 3072 
-        self.batch_tiles = 8       
+        # Presets padrão com os ajustes da implantação sobrepostos (por nome de preset)
+        self.presets = {name: dict(cfg) for name, cfg in DETECTION_PRESETS.items()}
+        for name, overrides in (presets or {}).items():
+            self.presets.setdefault(name, dict(DETECTION_PRESETS["balanced"])).update(overrides)
+        if default_preset not in self.presets:
+            raise ValueError(f"Preset padrão '{default_preset}' não existe. Opções: {list(self.presets)}")
+        self.default_preset = default_preset
+        self.batch_tiles = batch_tiles
+        # Pré-filtro opcional de tiles uniformes (céu, água, telhados, bordas vazias)
+        self.skip_uniform_tiles = skip_uniform_tiles
+        self.tile_min_std = 6.0
+        self.tile_min_edge = 2.0
+        # Réplicas do modelo: cada uma roda lotes numa thread própria, dividindo os núcleos
+        self.replicas = max(1, int(replicas))
+        self.models = [self.model] + [
+            load_model(model_path, backend=backend, precision=precision)[0] for _ in range(self.replicas - 1)
+        ]
+        for model in self.models:
+            try:
+                if hasattr(model, "fuse"):
+                    model.fuse()
+            except Exception:
+                pass
+        if intra_op_threads is None and self.replicas > 1:
+            intra_op_threads = max(1, (os.cpu_count() or 1) // self.replicas)
+        if intra_op_threads:
+            for model in self.models:
+                try:
+                    applied = set_intra_op_threads(model, backend, self.model_file, intra_op_threads)
+                except Exception as e:
+                    applied = False
+                    print("[WARN]", str(e))
+                if not applied:
+                    print(f"[WARN] Não foi possível limitar as threads intra-op do backend {backend}.")
+                    break
+        # Fila compartilhada: tiles de todas as requisições em andamento formam lotes juntos
+        self.batcher = TileBatcher(
+            [partial(self._infer_batch, model=model) for model in self.models],
+            max_batch=self.batch_tiles,
+            max_wait_ms=batch_wait_ms,
+        )
         try:
-            if hasattr(self.model, "fuse"):
-                self.model.fuse()
-        except Exception:
-            pass
-        print("Modelo carregado com as seguintes classes:", self.names)
+            self.model_hash = f"{file_sha256(model_path)}:{backend}:{precision}"
+        except OSError:
+            self.model_hash = f"{model_path}:{backend}:{precision}"
+        self.cache = DetectionCache(cache_dir) if cache_enabled else None
+        print(f"Modelo carregado ({backend}, {precision}) com as seguintes classes:", self.names)
+
+    def _infer_batch(self, tiles, model_args=None, model=None):
+        model = model if model is not None else self.model
+        results = model(tiles, verbose=False, **dict(model_args or ()))
+        outputs = []
+        for res in results:
+            boxes = res.boxes
+            if boxes is None or len(boxes) == 0:
+                outputs.append(None)
+                continue
+            xyxy = boxes.xyxy.cpu().numpy() if hasattr(boxes.xyxy, 'cpu') else np.array(boxes.xyxy)
+            conf = boxes.conf.cpu().numpy() if hasattr(boxes.conf, 'cpu') else np.array(boxes.conf)
+            cls = boxes.cls.cpu().numpy() if hasattr(boxes.cls, 'cpu') else np.array(boxes.cls)
+            outputs.append((
+                xyxy.astype(float).reshape(-1, 4),
+                conf.astype(float).reshape(-1),
+                cls.astype(int).reshape(-1),
+            ))
+        return outputs
 
     def calculate_intensity(self, objects):
         if not objects:
             return 0.0
-        
-        weights = {
-            "piscina_suja": 10.0,
-            "reservatorio_de_agua": 8.0,
-            "pneu": 6.0,
-            "lona": 4.0,
-            "monte_de_lixo": 3.0,
-            "saco_de_lixo": 2.0,
-            "piscina_limpa": 1.0
-        }
-        
-        total_score = 0.0
-        first_obj = objects[0]
-        img_w = first_obj["box"]["original_width"]
-        img_h = first_obj["box"]["original_height"]
-        total_img_area = float(img_w * img_h)
-
-        if total_img_area == 0:
-            for obj in objects:
-                weight = weights.get(obj["class"], 1.0) 
-                confidence = obj["confidence"]
-                total_score += weight * confidence
-            return total_score
-
-        for obj in objects:
-            weight = weights.get(obj["class"], 1.0) 
-            confidence = obj["confidence"]
-            
-            box = obj["box"]
-            w = box["x2"] - box["x1"]
-            h = box["y2"] - box["y1"]
-            obj_area = w * h
-            relative_area = obj_area / total_img_area
-            
-            # risco = Peso * Confiança * Área Relativa
-            risk_contribution = weight * confidence * relative_area
-            total_score += risk_contribution
-        
-        return total_score * 100.0
+        img_w = objects[0]["box"]["original_width"]
+        img_h = objects[0]["box"]["original_height"]
+        boxes = [[o["box"]["x1"], o["box"]["y1"], o["box"]["x2"], o["box"]["y2"]] for o in objects]
+        risk = [CLASS_WEIGHTS.get(o["class"], 1.0) * o["confidence"] for o in objects]
+        return _risk_map(boxes, risk, img_w, img_h)[0]
+
+    def risk_grid(self, objects, width, height, grid_cells: int, fmt: str = "array"):
+        # Recalcula a grade a partir de uma lista de objetos já pronta (ex.: resultado em cache)
+        validate_risk_grid(grid_cells, fmt)
+        boxes = [[o["box"]["x1"], o["box"]["y1"], o["box"]["x2"], o["box"]["y2"]] for o in objects]
+        risk = [CLASS_WEIGHTS.get(o["class"], 1.0) * o["confidence"] for o in objects]
+        _, grid = _risk_map(boxes, risk, width, height, grid_cells)
+        return _encode_risk_grid(grid, width, height, fmt) if grid is not None else None
+
+    def resolve_settings(self, preset: str | None = None, fast: bool = True):
+        name = preset or self.default_preset
+        if name not in self.presets:
+            raise ValueError(f"Preset '{name}' inválido. Opções: {list(self.presets)}")
+        settings = dict(self.presets[name], name=name)
+        if not fast:
+            settings["max_side"] = None
+        return settings
 
-    def detect_image(self, image_bytes, fast: bool = True):
-        img = Image.open(BytesIO(image_bytes)).convert("RGB")
+    @staticmethod
+    def model_args(settings):
+        # Argumentos repassados ao YOLO; também servem de chave de lote no agrupador
+        return tuple((k, settings[k]) for k in ("imgsz", "conf") if settings.get(k) is not None)
+
+    def load_image(self, image_source, max_side: int | None = None):
+        # Aceita bytes, caminho ou arquivo aberto. Para JPEG grande usa draft() para
+        # decodificar direto em 1/2, 1/4 ou 1/8 da resolução, sem alocar a imagem inteira.
+        # Arquivos abertos pelo chamador (ex.: upload temporário) ficam abertos ao final
+        owns_source = not hasattr(image_source, "read")
+        if isinstance(image_source, (bytes, bytearray, memoryview)):
+            image_source = BytesIO(image_source)
+        img = Image.open(image_source)
         orig_width, orig_height = img.size
 
         scale = 1.0
-        tile_size = self.tile_size
-        overlap = self.default_overlap
-
-        if fast:
-            max_side = max(orig_width, orig_height)
-            if max_side > self.fast_max_side:
-                scale = self.fast_max_side / float(max_side)
-                new_w = max(1, int(round(orig_width * scale)))
-                new_h = max(1, int(round(orig_height * scale)))
-                img_resized = img.resize((new_w, new_h), resample=Image.BILINEAR)
-            else:
-                img_resized = img
-        else:
-            img_resized = img
-
-        img_np = np.array(img_resized)
-        height, width = img_np.shape[:2]
-
-        stride = max(1, int(tile_size * (1 - overlap))) 
-
-        def compute_starts(total, size, stride):
-            starts = list(range(0, max(total - size, 0) + 1, stride))
-            if len(starts) == 0:
-                starts = [0]
-            last = max(total - size, 0)
-            if starts[-1] != last:
-                starts.append(last)
-            return starts
-
-        x_starts = compute_starts(width, tile_size, stride)
-        y_starts = compute_starts(height, tile_size, stride)
+        target = None
+        if max_side:
+            longest = max(orig_width, orig_height)
+            if longest > max_side:
+                scale = max_side / float(longest)
+                target = (max(1, int(round(orig_width * scale))), max(1, int(round(orig_height * scale))))
+                if img.format == "JPEG":
+                    img.draft("RGB", target)
+
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        if target is not None and img.size != target:
+            img = img.resize(target, resample=Image.BILINEAR, reducing_gap=3.0)
+
+        img_np = np.asarray(img)
+        if owns_source:
+            img.close()
+        return img_np, orig_width, orig_height, scale
+
+    def tile_grid(self, width, height, tile_size, overlap):
+        # Origens (x0, y0) de todos os tiles de uma imagem width x height
+        stride = max(1, int(tile_size * (1 - overlap)))
+        return [
+            (x0, y0)
+            for y0 in _tile_starts(height, tile_size, stride)
+            for x0 in _tile_starts(width, tile_size, stride)
+        ]
+
+    def is_uniform_tile(self, tile):
+        std, edges = _tile_content_score(tile)
+        return std < self.tile_min_std and edges < self.tile_min_edge
+
+    def select_tiles(self, img_np, settings, skip_uniform: bool | None = None):
+        if skip_uniform is None:
+            skip_uniform = self.skip_uniform_tiles
 
         tiles = []
         origins = [] 
-        for y0 in y_starts:
-            for x0 in x_starts:
-                x1 = x0
-                y1 = y0
-                x2 = min(x0 + tile_size, width)
-                y2 = min(y0 + tile_size, height)
-                tile = img_np[y1:y2, x1:x2, :]
-                if tile.size == 0:
-                    continue
-                tiles.append(tile)
-                origins.append((x1, y1))
-
-        all_boxes = []  
-        all_scores = []
-        all_classes = []
-
-        if len(tiles) > 0:
-            bs = max(1, int(self.batch_tiles))
-            for i in range(0, len(tiles), bs):
-                batch = tiles[i:i+bs]
-                batch_origins = origins[i:i+bs]
-                results = self.model(batch, verbose=False)
-                for res, (ox, oy) in zip(results, batch_origins):
-                    boxes = res.boxes
-                    if boxes is None or len(boxes) == 0:
-                        continue
-                    class_ids = boxes.cls.tolist()
-                    confidences = boxes.conf.tolist()
-                    xyxy = boxes.xyxy.cpu().numpy() if hasattr(boxes.xyxy, 'cpu') else np.array(boxes.xyxy)
-
-                    for j in range(len(class_ids)):
-                        bx1, by1, bx2, by2 = map(float, xyxy[j])
-                        all_boxes.append((bx1 + ox, by1 + oy, bx2 + ox, by2 + oy))
-                        all_scores.append(float(confidences[j]))
-                        all_classes.append(int(class_ids[j]))
-
-        final_boxes = []
-        final_scores = []
-        final_classes = []
-        all_boxes_np = np.array(all_boxes, dtype=float)
-        all_scores_np = np.array(all_scores, dtype=float)
-        all_classes_np = np.array(all_classes, dtype=int)
-
-        for cls in set(all_classes_np.tolist()) if len(all_classes_np) else []:
-            cls_mask = (all_classes_np == cls)
-            boxes_cls = all_boxes_np[cls_mask]
-            scores_cls = all_scores_np[cls_mask]
-            keep = _nms_xyxy(boxes_cls, scores_cls, iou_threshold=0.5)
-            for k in keep:
-                final_boxes.append(tuple(boxes_cls[k]))
-                final_scores.append(float(scores_cls[k]))
-                final_classes.append(int(cls))
+        skipped_tiles = 0
+        for x1, y1, tile in _iter_tiles(img_np, settings["tile_size"], settings["overlap"]):
+            if skip_uniform and self.is_uniform_tile(tile):
+                skipped_tiles += 1
+                continue
+            tiles.append(tile)
+            origins.append((x1, y1))
+        return tiles, origins, skipped_tiles
+
+    def infer_tiles(self, tiles, origins, settings):
+        # Roda os tiles pelo agrupador compartilhado e devolve as caixas já em
+        # coordenadas da imagem (arrays boxes, scores, classes)
+        outputs = self.batcher.infer(tiles, key=self.model_args(settings)) if len(tiles) > 0 else []
+        return self._collect_outputs(outputs, origins)
+
+    def _collect_outputs(self, outputs, origins):
+        box_chunks = []
+        score_chunks = []
+        class_chunks = []
+        for out, (ox, oy) in zip(outputs, origins):
+            if out is None:
+                continue
+            xyxy, conf, cls = out
+            box_chunks.append(xyxy + np.array([ox, oy, ox, oy], dtype=float))
+            score_chunks.append(conf)
+            class_chunks.append(cls)
+
+        all_boxes = np.concatenate(box_chunks) if box_chunks else np.zeros((0, 4), dtype=float)
+        all_scores = np.concatenate(score_chunks) if score_chunks else np.zeros(0, dtype=float)
+        all_classes = np.concatenate(class_chunks) if class_chunks else np.zeros(0, dtype=int)
+        return all_boxes, all_scores, all_classes
+
+    def filter_detections(self, all_boxes, all_scores, all_classes, scale=1.0, iou_threshold=0.5):
+        # Filtro de lona aplicado antes do NMS (resultado idêntico, menos caixas no NMS)
+        names = self.names.items() if isinstance(self.names, dict) else enumerate(self.names)
+        lona_ids = [int(k) for k, v in names if v == "lona"]
+        if len(all_classes) and lona_ids:
+            drop = np.isin(all_classes, lona_ids) & (all_scores < 0.6)
+            all_boxes, all_scores, all_classes = all_boxes[~drop], all_scores[~drop], all_classes[~drop]
+
+        keep = _batched_nms(all_boxes, all_scores, all_classes, iou_threshold=iou_threshold)
+        final_boxes = all_boxes[keep]
+        if scale != 1.0:
+            final_boxes = final_boxes * (1.0 / scale)
+        return final_boxes, all_scores[keep], all_classes[keep]
+
+    def merge_detections(self, all_boxes, all_scores, all_classes, scale, orig_width, orig_height, iou_threshold=0.5,
+                         risk_grid: int | None = None, risk_format: str = "array"):
+        final_boxes, final_scores, final_classes = self.filter_detections(
+            all_boxes, all_scores, all_classes, scale=scale, iou_threshold=iou_threshold)
 
         detections = []
         class_names = []
         for b, s, c in zip(final_boxes, final_scores, final_classes):
             x1, y1, x2, y2 = map(float, b)
-            if scale != 1.0:
-                inv = 1.0 / scale
-                x1 *= inv
-                y1 *= inv
-                x2 *= inv
-                y2 *= inv
             cname = self.names[int(c)]
-
-            if cname == "lona" and s < 0.6:
-                continue
-
             class_names.append(cname)
             detections.append({
                 "class": cname,
-                "confidence": round(s, 4),
+                "confidence": round(float(s), 4),
                 "box": {
                     "x1": x1, "y1": y1, "x2": x2, "y2": y2,
                     "original_width": orig_width, "original_height": orig_height
@@ -212,11 +403,150 @@ class DengueDetector:
             })
 
         counts = Counter(class_names)
-        intensity_score = self.calculate_intensity(detections)
+        # Mesmo cálculo de calculate_intensity, direto sobre os arrays (e com a grade, se pedida)
+        risk = np.array([CLASS_WEIGHTS.get(n, 1.0) for n in class_names]) * np.round(final_scores.astype(float), 4)
+        intensity_score, grid = _risk_map(final_boxes, risk, orig_width, orig_height, risk_grid)
+        if not detections:
+            intensity_score = 0.0
 
-        return {
+        result = {
             "total": len(detections),
             "contagem": counts,
             "objetos": detections,
-            "intensity_score": intensity_score
-        }
\ No newline at end of file
+            "intensity_score": intensity_score,
+        }
+        if grid is not None:
+            result["risk_grid"] = _encode_risk_grid(grid, orig_width, orig_height, risk_format)
+        return result
+
+    def cache_config(self, settings, skip_uniform: bool | None):
+        # Tudo o que muda o resultado da detecção entra na chave do cache
+        return {
+            # Versão do formato do resultado guardado (2 = inclui width/height)
+            "format": 2,
+            "model": self.model_hash,
+            **{k: v for k, v in settings.items() if k != "name"},
+            "skip_uniform": bool(self.skip_uniform_tiles if skip_uniform is None else skip_uniform),
+            "tile_min_std": self.tile_min_std,
+            "tile_min_edge": self.tile_min_edge,
+        }
+
+    def _cache_key(self, image_bytes, settings, skip_uniform):
+        if self.cache is None:
+            return None
+        if not isinstance(image_bytes, (bytes, bytearray, memoryview)) and not hasattr(image_bytes, "read"):
+            return None
+        return DetectionCache.make_key(image_bytes, self.cache_config(settings, skip_uniform))
+
+    def detect_image(self, image_bytes, fast: bool = True, skip_uniform: bool | None = None, preset: str | None = None,
+                     risk_grid: int | None = None, risk_format: str = "array"):
+        # risk_grid: número de células no lado maior da imagem (None = sem grade de risco)
+        validate_risk_grid(risk_grid, risk_format)
+        settings = self.resolve_settings(preset, fast=fast)
+        key = self._cache_key(image_bytes, settings, skip_uniform)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                result = {**cached, "cache": "hit"}
+                if risk_grid:
+                    result["risk_grid"] = self.risk_grid(cached["objetos"], cached["width"], cached["height"],
+                                                         risk_grid, risk_format)
+                return result
+
+        result = self._detect_image(image_bytes, settings, skip_uniform=skip_uniform,
+                                    risk_grid=risk_grid, risk_format=risk_format)
+        if key is not None:
+            # A grade depende só dos objetos e é refeita a partir deles num acerto de cache
+            self.cache.put(key, {k: v for k, v in result.items() if k != "risk_grid"})
+        result["cache"] = "miss" if key is not None else "disabled"
+        return result
+
+    def _detect_image(self, image_bytes, settings, skip_uniform: bool | None = None,
+                      risk_grid: int | None = None, risk_format: str = "array"):
+        img_np, orig_width, orig_height, scale = self.load_image(image_bytes, max_side=settings["max_side"])
+        tiles, origins, skipped_tiles = self.select_tiles(img_np, settings, skip_uniform=skip_uniform)
+        all_boxes, all_scores, all_classes = self.infer_tiles(tiles, origins, settings)
+
+        result = self.merge_detections(all_boxes, all_scores, all_classes, scale, orig_width, orig_height,
+                                       iou_threshold=settings["iou"], risk_grid=risk_grid, risk_format=risk_format)
+        result["width"] = orig_width
+        result["height"] = orig_height
+        result["preset"] = settings["name"]
+        result["tiles"] = {
+            "total": len(tiles) + skipped_tiles,
+            "processed": len(tiles),
+            "skipped": skipped_tiles,
+        }
+        return result
+
+    def detect_images(self, images, fast: bool = True, skip_uniform: bool | None = None, preset: str | None = None,
+                      max_workers: int = 4):
+        # images: (nome, origem), origem = bytes, arquivo aberto ou função que devolve os bytes
+        # (entrada de .zip lida só quando a vez dela chega). A decodificação roda num pool de
+        # threads e os tiles das imagens em andamento entram juntos na fila do agrupador.
+        settings = self.resolve_settings(preset, fast=fast)
+        max_workers = max(1, int(max_workers))
+
+        def prepare(source):
+            data = source() if callable(source) else source
+            key = self._cache_key(data, settings, skip_uniform)
+            cached = self.cache.get(key) if key is not None else None
+            if cached is not None:
+                return key, {**cached, "cache": "hit"}
+            img_np, orig_width, orig_height, scale = self.load_image(data, max_side=settings["max_side"])
+            tiles, origins, skipped = self.select_tiles(img_np, settings, skip_uniform=skip_uniform)
+            futures = self.batcher.submit(tiles, key=self.model_args(settings))
+            return key, (futures, origins, skipped, scale, orig_width, orig_height)
+
+        def finish(name, fut):
+            try:
+                key, prepared = fut.result()
+                if isinstance(prepared, dict):
+                    return {"filename": name, **prepared}
+                futures, origins, skipped, scale, orig_width, orig_height = prepared
+                outputs = [f.result() for f in futures]
+                boxes, scores, classes = self._collect_outputs(outputs, origins)
+                result = self.merge_detections(boxes, scores, classes, scale, orig_width, orig_height,
+                                               iou_threshold=settings["iou"])
+                result["width"] = orig_width
+                result["height"] = orig_height
+                result["preset"] = settings["name"]
+                result["tiles"] = {
+                    "total": len(futures) + skipped,
+                    "processed": len(futures),
+                    "skipped": skipped,
+                }
+                if key is not None:
+                    self.cache.put(key, result)
+                result["cache"] = "miss" if key is not None else "disabled"
+                return {"filename": name, **result}
+            except Exception as e:
+                return {"filename": name, "error": str(e)}
+
+        # No máximo max_workers imagens decodificadas ao mesmo tempo: cada uma segura seus
+        # tiles (e a imagem inteira) até os resultados serem lidos
+        results = []
+        inflight = deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for name, source in images:
+                inflight.append((name, pool.submit(prepare, source)))
+                if len(inflight) >= max_workers:
+                    results.append(finish(*inflight.popleft()))
+            while inflight:
+                results.append(finish(*inflight.popleft()))
+
+        ok = [r for r in results if "error" not in r]
+        counts = Counter()
+        for r in ok:
+            counts.update(r["contagem"])
+        scores = [r["intensity_score"] for r in ok]
+        return {
+            "preset": settings["name"],
+            "images": len(results),
+            "failed": len(results) - len(ok),
+            "total": sum(r["total"] for r in ok),
+            "contagem": counts,
+            # Média por imagem: o score de cada imagem já é relativo à sua área
+            "intensity_score": float(np.mean(scores)) if scores else 0.0,
+            "results": results,
+        }
@@ -0,0 +1,202 @@
+import argparse
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from ultralytics import YOLO
+
+# Combinações suportadas de backend de inferência e precisão
+BACKEND_PRECISIONS = {
+    "torch": ("fp32",),
+    "onnx": ("fp32",),
+    "openvino": ("fp32", "fp16", "int8"),
+}
+
+
+def export_path(model_path, backend: str, precision: str):
+    model_path = Path(model_path)
+    if backend == "onnx":
+        return model_path.with_name(f"{model_path.stem}_{precision}.onnx")
+    if backend == "openvino":
+        return model_path.with_name(f"{model_path.stem}_{precision}_openvino_model")
+    return model_path
+
+
+def export_model(model_path, backend: str, precision: str = "fp32", imgsz: int = 1024,
+                 calibration_data: str | None = None):
+    """Exporta o .pt uma única vez e guarda o resultado ao lado do modelo original.
+
+    A exportação é refeita só quando o .pt é mais novo que o arquivo exportado.
+    int8 exige `calibration_data` (YAML de dataset do ultralytics com imagens
+    aéreas representativas); sem ele o ultralytics calibraria com o COCO8,
+    baixado da internet e sem relação com as imagens de drone.
+    """
+    if backend not in BACKEND_PRECISIONS:
+        raise ValueError(f"Backend '{backend}' inválido. Opções: {list(BACKEND_PRECISIONS)}")
+    if precision not in BACKEND_PRECISIONS[backend]:
+        raise ValueError(f"Precisão '{precision}' não suportada para '{backend}'. Opções: {list(BACKEND_PRECISIONS[backend])}")
+    model_path = Path(model_path)
+    if backend == "torch":
+        return model_path
+
+    target = export_path(model_path, backend, precision)
+    if target.exists() and target.stat().st_mtime >= model_path.stat().st_mtime:
+        return target
+
+    if precision == "int8" and not calibration_data:
+        raise ValueError("Exportação int8 requer um dataset de calibração (calibration_data).")
+    print(f"Exportando {model_path.name} para {backend} ({precision})...")
+    exported = YOLO(str(model_path)).export(
+        format=backend,
+        imgsz=imgsz,
+        dynamic=True,
+        half=(precision == "fp16"),
+        int8=(precision == "int8"),
+        **({"data": calibration_data} if precision == "int8" else {}),
+    )
+    exported = Path(exported)
+    if target.exists():
+        shutil.rmtree(target) if target.is_dir() else target.unlink()
+    exported.rename(target)
+    return target
+
+
+def load_model(model_path, backend: str = "torch", precision: str = "fp32", imgsz: int = 1024,
+               calibration_data: str | None = None):
+    path = export_model(model_path, backend, precision, imgsz=imgsz, calibration_data=calibration_data)
+    return YOLO(str(path), task="detect"), path
+
+
+def set_intra_op_threads(model, backend: str, model_file, threads: int):
+    """Limita as threads intra-op usadas na inferência de um modelo já carregado.
+
+    No torch o ajuste é do processo inteiro (torch.set_num_threads) e vale para
+    todas as réplicas. No ONNX Runtime e no OpenVINO o limite é da sessão: o
+    modelo roda uma vez para o ultralytics criar a sessão, que é refeita com o
+    limite. Devolve False se a sessão não pôde ser ajustada.
+    """
+    threads = int(threads)
+    if backend == "torch":
+        import torch
+        torch.set_num_threads(threads)
+        return True
+
+    model(np.zeros((32, 32, 3), dtype=np.uint8), verbose=False)
+    session_backend = getattr(getattr(model, "predictor", None), "model", None)
+    if backend == "onnx" and hasattr(session_backend, "session"):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        providers = session_backend.session.get_providers()
+        session_backend.session = ort.InferenceSession(str(model_file), sess_options=options, providers=providers)
+        return True
+    if backend == "openvino" and hasattr(session_backend, "ov_compiled_model"):
+        import openvino as ov
+        core = ov.Core()
+        ov_model = getattr(session_backend, "ov_model", None) or core.read_model(next(Path(model_file).glob("*.xml")))
+        config = {"INFERENCE_NUM_THREADS": threads,
+                  "PERFORMANCE_HINT": getattr(session_backend, "inference_mode", "LATENCY")}
+        session_backend.ov_compiled_model = core.compile_model(ov_model, "CPU", config=config)
+        return True
+    return False
+
+
+def _tile_outputs(model, tiles, **kwargs):
+    outputs = []
+    for res in model(tiles, verbose=False, **kwargs):
+        boxes = res.boxes
+        if boxes is None or len(boxes) == 0:
+            outputs.append((np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=int)))
+            continue
+        outputs.append((
+            boxes.xyxy.cpu().numpy().astype(float),
+            boxes.conf.cpu().numpy().astype(float),
+            boxes.cls.cpu().numpy().astype(int),
+        ))
+    return outputs
+
+
+def _time_per_tile(model, tiles, runs, **kwargs):
+    model(tiles[:1], verbose=False, **kwargs)  # aquecimento
+    start = time.perf_counter()
+    for _ in range(runs):
+        outputs = _tile_outputs(model, tiles, **kwargs)
+    elapsed = time.perf_counter() - start
+    return outputs, elapsed / (runs * len(tiles)) * 1000.0
+
+
+def _match_ratio(ref, other, iou_threshold=0.5):
+    # Fração das caixas de referência com correspondente (mesma classe, IoU >= limiar)
+    (rb, rs, rc), (ob, os_, oc) = ref, other
+    if len(rb) == 0:
+        return 1.0 if len(ob) == 0 else 0.0, 0.0
+    matched, conf_diff = 0, 0.0
+    for box, score, cls in zip(rb, rs, rc):
+        same = oc == cls
+        if not same.any():
+            continue
+        cand = ob[same]
+        inter_w = np.clip(np.minimum(box[2], cand[:, 2]) - np.maximum(box[0], cand[:, 0]), 0, None)
+        inter_h = np.clip(np.minimum(box[3], cand[:, 3]) - np.maximum(box[1], cand[:, 1]), 0, None)
+        inter = inter_w * inter_h
+        union = (box[2] - box[0]) * (box[3] - box[1]) + (cand[:, 2] - cand[:, 0]) * (cand[:, 3] - cand[:, 1]) - inter
+        iou = np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+        best = int(np.argmax(iou))
+        if iou[best] >= iou_threshold:
+            matched += 1
+            conf_diff = max(conf_diff, abs(float(os_[same][best]) - float(score)))
+    return matched / len(rb), conf_diff
+
+
+def compare_backends(model_path, tiles, backend: str, precision: str = "fp32", runs: int = 3, imgsz: int | None = None,
+                     calibration_data: str | None = None):
+    """Checa paridade entre o backend PyTorch e o exportado e mede a latência por tile."""
+    kwargs = {"imgsz": imgsz} if imgsz else {}
+    torch_model = YOLO(str(model_path))
+    other_model, other_path = load_model(model_path, backend, precision, imgsz=imgsz or 1024,
+                                         calibration_data=calibration_data)
+
+    torch_out, torch_ms = _time_per_tile(torch_model, tiles, runs, **kwargs)
+    other_out, other_ms = _time_per_tile(other_model, tiles, runs, **kwargs)
+
+    ratios, conf_diffs = zip(*[_match_ratio(a, b) for a, b in zip(torch_out, other_out)])
+    return {
+        "backend": backend,
+        "precision": precision,
+        "export_path": str(other_path),
+        "tiles": len(tiles),
+        "torch_ms_per_tile": round(torch_ms, 2),
+        "backend_ms_per_tile": round(other_ms, 2),
+        "speedup": round(torch_ms / other_ms, 2) if other_ms > 0 else None,
+        "torch_detections": int(sum(len(o[0]) for o in torch_out)),
+        "backend_detections": int(sum(len(o[0]) for o in other_out)),
+        "match_ratio": round(float(np.mean(ratios)), 4),
+        "max_conf_diff": round(float(max(conf_diffs)), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta o detector e compara com o backend PyTorch.")
+    parser.add_argument("image", help="Imagem usada para gerar os tiles de teste")
+    parser.add_argument("--model", default="./models/detect.pt")
+    parser.add_argument("--backend", default="onnx", choices=[b for b in BACKEND_PRECISIONS if b != "torch"])
+    parser.add_argument("--precision", default="fp32")
+    parser.add_argument("--calibration-data", default=None,
+                        help="YAML de dataset do ultralytics para calibrar a exportação int8")
+    parser.add_argument("--tile-size", type=int, default=1024)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    img = np.asarray(Image.open(args.image).convert("RGB"))
+    t = args.tile_size
+    tiles = [img[y:y + t, x:x + t] for y in range(0, img.shape[0], t) for x in range(0, img.shape[1], t)]
+    report = compare_backends(args.model, tiles, args.backend, args.precision, runs=args.runs,
+                              calibration_data=args.calibration_data)
+    for k, v in report.items():
+        print(f"{k}: {v}")
+
+
+if __name__ == "__main__":
+    main()
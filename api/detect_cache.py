@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+def file_sha256(path, chunk_size: int = 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while chunk := fh.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DetectionCache:
+    """Cache de resultados de detecção em memória (LRU) e em disco (um JSON por chave).
+
+    A chave combina o hash do conteúdo da imagem com a configuração do detector,
+    então trocar o modelo ou a geometria dos tiles nunca devolve resultado antigo.
+    """
+
+    def __init__(self, cache_dir=None, max_memory_items: int = 256, max_disk_items: int = 2000):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+        # Entradas em disco contadas uma vez aqui e mantidas a cada escrita/remoção
+        self._disk_count = 0
+        if self.cache_dir is not None:
+            try:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                self._disk_count = sum(1 for _ in self.cache_dir.glob("*.json"))
+            except OSError as e:
+                print(f"[WARN] Cache de detecção em disco desativado ({self.cache_dir}):", str(e))
+                self.cache_dir = None
+
+    @staticmethod
+    def make_key(image_source, config: dict, chunk_size: int = 1024 * 1024):
+        # Aceita bytes ou arquivo aberto (lido inteiro em blocos e devolvido à posição original)
+        digest = hashlib.sha256()
+        digest.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+        digest.update(b"\0")
+        if isinstance(image_source, (bytes, bytearray, memoryview)):
+            digest.update(image_source)
+        else:
+            start = image_source.tell()
+            image_source.seek(0)
+            while chunk := image_source.read(chunk_size):
+                digest.update(chunk)
+            image_source.seek(start)
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._memory[key]
+        if self.cache_dir is not None:
+            path = self.cache_dir / f"{key}.json"
+            try:
+                with open(path, "r", encoding="utf-8") as fh:
+                    result = json.load(fh)
+                os.utime(path)
+                self._remember(key, result)
+                with self._lock:
+                    self.stats["hits"] += 1
+                return result
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                print(f"[WARN] Falha ao ler o cache de detecção {path.name}:", str(e))
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, result):
+        # Normaliza via JSON para que memória e disco devolvam o mesmo formato
+        payload = json.dumps(result)
+        result = json.loads(payload)
+        self._remember(key, result)
+        if self.cache_dir is None:
+            return
+        # Gravar em disco é só uma otimização: falhas (disco cheio, permissão) não derrubam a detecção
+        path = self.cache_dir / f"{key}.json"
+        tmp = self.cache_dir / f"{key}.{threading.get_ident()}.tmp"
+        try:
+            existed = path.exists()
+            with open(tmp, "w", encoding="utf-8") as fh:
+                fh.write(payload)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[WARN] Falha ao gravar o cache de detecção {path.name}:", str(e))
+            tmp.unlink(missing_ok=True)
+            return
+        with self._lock:
+            if not existed:
+                self._disk_count += 1
+            full = self._disk_count > self.max_disk_items
+        if full:
+            self._evict_disk()
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._memory[key] = result
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        # Remove as entradas mais antigas até 90% do limite, para não varrer a pasta a cada escrita
+        entries = []
+        try:
+            for path in self.cache_dir.glob("*.json"):
+                try:
+                    entries.append((path.stat().st_mtime, path))
+                except FileNotFoundError:
+                    continue
+        except OSError as e:
+            print("[WARN] Falha ao listar o cache de detecção:", str(e))
+            return
+        entries.sort()
+        target = int(self.max_disk_items * 0.9)
+        removed = 0
+        for _, path in entries[:max(0, len(entries) - target)]:
+            try:
+                path.unlink(missing_ok=True)
+                removed += 1
+            except OSError as e:
+                print(f"[WARN] Falha ao remover {path.name} do cache de detecção:", str(e))
+        with self._lock:
+            self._disk_count = len(entries) - removed
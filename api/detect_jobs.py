@@ -0,0 +1,245 @@
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from detect import validate_risk_grid
+
+try:
+    import rasterio
+    from rasterio.windows import Window
+except ImportError:
+    rasterio = None
+
+
+class _RasterioWindowReader:
+    # Leitura janela a janela (GeoTIFF/ortomosaicos): só o tile pedido é decodificado
+    def __init__(self, path, stats_side: int = 1024):
+        self.ds = rasterio.open(path)
+        self.width, self.height = self.ds.width, self.ds.height
+        count = self.ds.count
+        self.bands = [1, 2, 3] if count >= 3 else [1, 1, 1]
+        self.scale = None
+        if self.ds.dtypes[0] != "uint8":
+            self.scale = self._dataset_range(stats_side)
+
+    def _dataset_range(self, stats_side):
+        # Faixa única para o ortomosaico inteiro, medida numa leitura reduzida (usa as overviews
+        # quando existem) e ignorando nodata: janelas vizinhas ficam com o mesmo brilho, e dados
+        # de 12 bits gravados em uint16 ocupam a faixa toda em vez de saírem escuros
+        factor = max(1.0, max(self.width, self.height) / float(stats_side))
+        out_shape = (len(self.bands), max(1, int(self.height / factor)), max(1, int(self.width / factor)))
+        sample = self.ds.read(indexes=self.bands, out_shape=out_shape, masked=True)
+        valid = sample.compressed()
+        valid = valid[np.isfinite(valid)]
+        if valid.size == 0:
+            return 0.0, 1.0
+        # Percentis em vez de mínimo/máximo para que poucos pixels extremos não achatem o resto
+        low, high = (float(v) for v in np.percentile(valid, [0.5, 99.5]))
+        if np.issubdtype(sample.dtype, np.integer) and low >= 0:
+            low = 0.0
+        return low, max(high, low + 1e-6)
+
+    def read(self, x, y, w, h):
+        data = self.ds.read(indexes=self.bands, window=Window(x, y, w, h), masked=self.scale is not None)
+        if self.scale is not None:
+            low, high = self.scale
+            data = np.ma.filled(data.astype(np.float32), low)
+            data = np.nan_to_num((data - low) * (255.0 / (high - low)), nan=0.0)
+            data = data.clip(0, 255).astype(np.uint8)
+        return np.moveaxis(data, 0, -1)
+
+    def close(self):
+        self.ds.close()
+
+
+class _PILWindowReader:
+    # Fallback sem rasterio: decodifica a imagem inteira uma vez e recorta as janelas, então a
+    # memória cresce com a imagem. Acima de Image.MAX_IMAGE_PIXELS (proteção do Pillow contra
+    # bombas de descompressão) a imagem é recusada; ortomosaicos maiores precisam do rasterio.
+    def __init__(self, path):
+        try:
+            img = Image.open(path)
+        except Image.DecompressionBombError:
+            img = None
+        limit = Image.MAX_IMAGE_PIXELS
+        if img is None or (limit and img.width * img.height > limit):
+            if img is not None:
+                img.close()
+            raise ValueError(f"Imagem maior que {limit} pixels; instale o rasterio para processá-la em janelas.")
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        self.img_np = np.asarray(img)
+        img.close()
+        self.height, self.width = self.img_np.shape[:2]
+
+    def read(self, x, y, w, h):
+        return self.img_np[y:y + h, x:x + w]
+
+    def close(self):
+        self.img_np = None
+
+
+def open_window_reader(path):
+    if rasterio is not None:
+        try:
+            return _RasterioWindowReader(path)
+        except Exception:
+            pass
+    return _PILWindowReader(path)
+
+
+class DetectionJob:
+    def __init__(self, job_id, path, filename, skip_uniform, settings, risk_grid=None, risk_format="array"):
+        self.job_id = job_id
+        self.path = Path(path)
+        self.filename = filename
+        self.skip_uniform = skip_uniform
+        self.settings = settings
+        self.risk_grid = risk_grid
+        self.risk_format = risk_format
+        self.status = "queued"
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.width = None
+        self.height = None
+        self.tiles_total = 0
+        self.tiles_done = 0
+        self.tiles_skipped = 0
+        self.result = None
+        self.lock = threading.Lock()
+        self._boxes = []
+        self._scores = []
+        self._classes = []
+
+
+class DetectionJobManager:
+    """Fila de detecção assíncrona para imagens muito grandes.
+
+    O upload já vem salvo em disco; um worker lê a imagem tile a tile, envia
+    os tiles em lotes ao detector e acumula as caixas, de modo que a memória
+    usada depende do tamanho do lote e não do tamanho da imagem.
+    """
+
+    def __init__(self, detector, jobs_dir, max_workers: int = 1, max_jobs_kept: int = 100):
+        self.detector = detector
+        self.jobs_dir = Path(jobs_dir)
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self.max_jobs_kept = max_jobs_kept
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="detect-job")
+
+    def new_upload_path(self, filename: str | None):
+        suffix = Path(filename or "").suffix.lower() or ".bin"
+        return self.jobs_dir / f"{uuid.uuid4().hex}{suffix}"
+
+    def submit(self, path, filename=None, skip_uniform=None, preset=None, risk_grid=None, risk_format="array"):
+        # Ortomosaicos são sempre processados na resolução original (sem max_side)
+        settings = self.detector.resolve_settings(preset, fast=False)
+        validate_risk_grid(risk_grid, risk_format)
+        job = DetectionJob(uuid.uuid4().hex, path, filename, skip_uniform, settings,
+                           risk_grid=risk_grid, risk_format=risk_format)
+        with self._lock:
+            self.jobs[job.job_id] = job
+            self._evict()
+        self._executor.submit(self._run, job)
+        return job.job_id
+
+    def _evict(self):
+        finished = [j for j in self.jobs.values() if j.status in ("done", "error")]
+        finished.sort(key=lambda j: j.finished_at or j.created_at)
+        while len(self.jobs) > self.max_jobs_kept and finished:
+            del self.jobs[finished.pop(0).job_id]
+
+    def _run(self, job):
+        job.status = "running"
+        reader = None
+        try:
+            reader = open_window_reader(job.path)
+            job.width, job.height = reader.width, reader.height
+            settings = job.settings
+            tile_size = settings["tile_size"]
+            grid = self.detector.tile_grid(reader.width, reader.height, tile_size, settings["overlap"])
+            job.tiles_total = len(grid)
+            skip_uniform = self.detector.skip_uniform_tiles if job.skip_uniform is None else job.skip_uniform
+            bs = max(1, int(self.detector.batch_tiles))
+
+            for i in range(0, len(grid), bs):
+                tiles, origins = [], []
+                for x0, y0 in grid[i:i + bs]:
+                    w = min(tile_size, reader.width - x0)
+                    h = min(tile_size, reader.height - y0)
+                    tile = reader.read(x0, y0, w, h)
+                    if tile.size == 0 or (skip_uniform and self.detector.is_uniform_tile(tile)):
+                        job.tiles_skipped += 1
+                        continue
+                    tiles.append(tile)
+                    origins.append((x0, y0))
+
+                boxes, scores, classes = self.detector.infer_tiles(tiles, origins, settings)
+                with job.lock:
+                    if len(boxes):
+                        job._boxes.append(boxes)
+                        job._scores.append(scores)
+                        job._classes.append(classes)
+                    job.tiles_done = min(i + bs, len(grid))
+
+            job.result = self._merge(job)
+            job.status = "done"
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = "error"
+        finally:
+            job.finished_at = time.time()
+            if reader is not None:
+                reader.close()
+            job.path.unlink(missing_ok=True)
+
+    def _merge(self, job):
+        with job.lock:
+            boxes = np.concatenate(job._boxes) if job._boxes else np.zeros((0, 4), dtype=float)
+            scores = np.concatenate(job._scores) if job._scores else np.zeros(0, dtype=float)
+            classes = np.concatenate(job._classes) if job._classes else np.zeros(0, dtype=int)
+        result = self.detector.merge_detections(boxes, scores, classes, 1.0, job.width, job.height,
+                                                iou_threshold=job.settings["iou"],
+                                                risk_grid=job.risk_grid, risk_format=job.risk_format)
+        result["preset"] = job.settings["name"]
+        result["tiles"] = {
+            "total": job.tiles_total,
+            "processed": job.tiles_done - job.tiles_skipped,
+            "skipped": job.tiles_skipped,
+        }
+        return result
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        status = {
+            "job_id": job.job_id,
+            "filename": job.filename,
+            "status": job.status,
+            "preset": job.settings["name"],
+            "progress": {
+                "tiles_done": job.tiles_done,
+                "tiles_total": job.tiles_total,
+                "fraction": round(job.tiles_done / job.tiles_total, 4) if job.tiles_total else 0.0,
+            },
+            "width": job.width,
+            "height": job.height,
+            "error": job.error,
+        }
+        if job.status == "done":
+            status["result"] = job.result
+        elif job.status == "running" and job.width is not None:
+            # Resultado parcial com os tiles já processados
+            status["result"] = self._merge(job)
+        return status
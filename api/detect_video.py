@@ -0,0 +1,235 @@
+from collections import Counter, deque
+
+import numpy as np
+
+from detect import CLASS_WEIGHTS, _batched_nms, _risk_map
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+def frame_hash(gray_small):
+    # dHash de 64 bits: compara pixels vizinhos numa versão 9x8 do quadro
+    tiny = cv2.resize(gray_small, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (tiny[:, 1:] > tiny[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def _hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def _suppress_contained(boxes, classes, ratio=0.7):
+    # Objeto cortado na borda de um quadro aparece como caixa menor contida na caixa
+    # completa de outro quadro; o IoU não pega esse caso, a fração contida sim.
+    order = np.argsort(-((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])))
+    keep = []
+    for i in order:
+        if keep:
+            kept = boxes[keep]
+            inter_w = np.clip(np.minimum(boxes[i, 2], kept[:, 2]) - np.maximum(boxes[i, 0], kept[:, 0]), 0, None)
+            inter_h = np.clip(np.minimum(boxes[i, 3], kept[:, 3]) - np.maximum(boxes[i, 1], kept[:, 1]), 0, None)
+            area = max((boxes[i, 2] - boxes[i, 0]) * (boxes[i, 3] - boxes[i, 1]), 1e-9)
+            if np.any((classes[keep] == classes[i]) & (inter_w * inter_h / area >= ratio)):
+                continue
+        keep.append(i)
+    return np.array(sorted(keep), dtype=int)
+
+
+class _Segment:
+    def __init__(self, index, start):
+        self.index = index
+        self.start = start
+        self.end = start
+        self.frames = 0
+        self.intensities = []
+        self.boxes = []
+        self.scores = []
+        self.classes = []
+
+
+class VideoDetector:
+    """Detecção em vídeo de drone lendo os quadros em fluxo.
+
+    Os quadros são amostrados a `sample_fps`; quadros quase idênticos ao último
+    aproveitado (dHash) são descartados. Os tiles dos quadros restantes vão para
+    o agrupador do detector, com no máximo `max_inflight` quadros em memória.
+    O deslocamento entre quadros é estimado por correlação de fase, de modo que
+    as caixas de quadros diferentes caem num mesmo referencial e o mesmo objeto
+    visto várias vezes dentro de um segmento é contado uma vez só.
+    """
+
+    def __init__(self, detector, sample_fps: float = 1.0, segment_seconds: float = 10.0,
+                 hash_threshold: int = 4, max_inflight: int = 4, registration_side: int = 256,
+                 min_registration_response: float = 0.1):
+        if cv2 is None:
+            raise RuntimeError("Detecção em vídeo requer o pacote opencv-python.")
+        self.detector = detector
+        self.sample_fps = float(sample_fps)
+        self.segment_seconds = float(segment_seconds)
+        self.hash_threshold = int(hash_threshold)
+        self.max_inflight = max(1, int(max_inflight))
+        self.registration_side = int(registration_side)
+        self.min_registration_response = float(min_registration_response)
+
+    def _prepare(self, frame_bgr, settings):
+        height, width = frame_bgr.shape[:2]
+        scale = 1.0
+        if settings["max_side"] and max(width, height) > settings["max_side"]:
+            scale = settings["max_side"] / float(max(width, height))
+            frame_bgr = cv2.resize(frame_bgr, (max(1, round(width * scale)), max(1, round(height * scale))),
+                                   interpolation=cv2.INTER_AREA)
+        # Mesmo formato (RGB) usado no caminho de imagens estáticas
+        return cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB), scale
+
+    def _small_gray(self, frame_bgr):
+        height, width = frame_bgr.shape[:2]
+        reg_scale = min(1.0, self.registration_side / float(max(width, height)))
+        gray = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2GRAY)
+        if reg_scale < 1.0:
+            gray = cv2.resize(gray, (max(1, round(width * reg_scale)), max(1, round(height * reg_scale))),
+                              interpolation=cv2.INTER_AREA)
+        return gray.astype(np.float32), reg_scale
+
+    def detect(self, path, skip_uniform: bool | None = None, preset: str | None = None, fast: bool = True,
+               sample_fps: float | None = None, segment_seconds: float | None = None):
+        sample_fps = self.sample_fps if sample_fps is None else float(sample_fps)
+        segment_seconds = self.segment_seconds if segment_seconds is None else float(segment_seconds)
+        settings = self.detector.resolve_settings(preset, fast=fast)
+        model_args = self.detector.model_args(settings)
+        cap = cv2.VideoCapture(str(path))
+        if not cap.isOpened():
+            raise ValueError("Não foi possível abrir o vídeo.")
+
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        step = max(1, int(round(fps / sample_fps))) if sample_fps > 0 else 1
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+
+        stats = {"read": 0, "sampled": 0, "duplicates": 0, "processed": 0}
+        segments = []
+        inflight = deque()
+        state = {"segment": None, "width": None, "height": None}
+        last_hash = None
+        prev_gray = None
+        offset = np.zeros(2)
+
+        def close_segment():
+            seg = state["segment"]
+            if seg is not None:
+                segments.append(self._summarize(seg, settings))
+            state["segment"] = None
+
+        def finish(item):
+            futures, origins, scale, world_offset, t = item
+            outputs = [f.result() for f in futures]
+            boxes, scores, classes = self.detector._collect_outputs(outputs, origins)
+            boxes, scores, classes = self.detector.filter_detections(
+                boxes, scores, classes, scale=scale, iou_threshold=settings["iou"])
+            names = [self.detector.names[int(c)] for c in classes]
+            risk = np.array([CLASS_WEIGHTS.get(n, 1.0) for n in names]) * np.round(scores.astype(float), 4)
+            intensity = _risk_map(boxes, risk, state["width"], state["height"])[0] if len(boxes) else 0.0
+
+            index = int(t // segment_seconds) if segment_seconds > 0 else 0
+            if state["segment"] is not None and state["segment"].index != index:
+                close_segment()
+            if state["segment"] is None:
+                state["segment"] = _Segment(index, t)
+            seg = state["segment"]
+            seg.end = t
+            seg.frames += 1
+            seg.intensities.append(intensity)
+            if len(boxes):
+                # Caixas no referencial acumulado do voo (desfaz o deslocamento da câmera)
+                seg.boxes.append(boxes - np.concatenate([world_offset, world_offset]))
+                seg.scores.append(scores)
+                seg.classes.append(classes)
+            stats["processed"] += 1
+
+        try:
+            frame_index = -1
+            while True:
+                frame_index += 1
+                # grab() só avança o fluxo; a decodificação completa fica para os quadros amostrados
+                if not cap.grab():
+                    break
+                stats["read"] += 1
+                if frame_index % step:
+                    continue
+                ok, frame = cap.retrieve()
+                if not ok:
+                    break
+                stats["sampled"] += 1
+                t = frame_index / fps
+                state["height"], state["width"] = frame.shape[:2]
+
+                gray, reg_scale = self._small_gray(frame)
+                h = frame_hash(gray)
+                if last_hash is not None and _hamming(h, last_hash) <= self.hash_threshold:
+                    stats["duplicates"] += 1
+                    continue
+                last_hash = h
+
+                if prev_gray is not None and prev_gray.shape == gray.shape:
+                    (dx, dy), response = cv2.phaseCorrelate(prev_gray, gray)
+                    if response >= self.min_registration_response:
+                        offset += np.array([dx, dy]) / reg_scale
+                    else:
+                        # Sem correspondência confiável: afasta o referencial para não fundir objetos
+                        offset += np.array([2.0 * state["width"], 0.0])
+                prev_gray = gray
+
+                rgb, scale = self._prepare(frame, settings)
+                tiles, origins, _ = self.detector.select_tiles(rgb, settings, skip_uniform=skip_uniform)
+                futures = self.detector.batcher.submit(tiles, key=model_args)
+                inflight.append((futures, origins, scale, offset.copy(), t))
+                while len(inflight) > self.max_inflight:
+                    finish(inflight.popleft())
+            while inflight:
+                finish(inflight.popleft())
+            close_segment()
+        finally:
+            cap.release()
+
+        counts = Counter()
+        for seg in segments:
+            counts.update(seg["contagem"])
+        intensities = [seg["intensity_score"] for seg in segments]
+        return {
+            "preset": settings["name"],
+            "video": {
+                "fps": fps,
+                "frames": frame_count or stats["read"],
+                "duration": round((frame_count or stats["read"]) / fps, 3),
+                "width": state["width"],
+                "height": state["height"],
+            },
+            "frames": stats,
+            "total": sum(seg["total"] for seg in segments),
+            "contagem": counts,
+            "intensity_score": float(np.mean(intensities)) if intensities else 0.0,
+            "segments": segments,
+        }
+
+    def _summarize(self, seg, settings):
+        if seg.boxes:
+            boxes = np.concatenate(seg.boxes)
+            scores = np.concatenate(seg.scores)
+            classes = np.concatenate(seg.classes)
+            keep = _batched_nms(boxes, scores, classes, iou_threshold=settings["iou"])
+            boxes, classes = boxes[keep], classes[keep]
+            keep = _suppress_contained(boxes, classes)
+            names = [self.detector.names[int(c)] for c in classes[keep]]
+        else:
+            names = []
+        return {
+            "segment": seg.index,
+            "start": round(seg.start, 3),
+            "end": round(seg.end, 3),
+            "frames": seg.frames,
+            "total": len(names),
+            "contagem": Counter(names),
+            # Média por quadro: o score de cada quadro é relativo à área do quadro
+            "intensity_score": float(np.mean(seg.intensities)) if seg.intensities else 0.0,
+        }
@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+
+
+class HistoricRollup:
+    """Cubo pré-agregado de casos semanais por Brasil, região e estado.
+
+    Cada nível guarda uma matriz (unidades x semanas) e a sua soma acumulada ao
+    longo das semanas, de modo que o total de qualquer janela de semanas
+    epidemiológicas sai de duas leituras da soma acumulada.
+    """
+
+    levels = ("brasil", "regiao", "estado")
+
+    def __init__(self, df: pd.DataFrame, population: dict | None = None):
+        population = population or {}
+        df = df[["codigo_ibge", "ano", "semana", "numero_casos", "estado_sigla", "regiao"]]
+        df = df.dropna(subset=["estado_sigla"])
+
+        week_key = df["ano"].astype(int).to_numpy() * 100 + df["semana"].astype(int).to_numpy()
+        self.week_keys, week_idx = np.unique(week_key, return_inverse=True)
+        n_weeks = len(self.week_keys)
+        years, weeks = self.week_keys // 100, self.week_keys % 100
+        dates = pd.to_datetime(
+            pd.Series(years.astype(str)) + pd.Series(weeks.astype(str)) + "0", format="%Y%W%w", errors="coerce"
+        )
+        self.week_dates = [d.strftime("%Y-%m-%d") if pd.notna(d) else None for d in dates]
+
+        states = df["estado_sigla"].astype(str).str.upper().to_numpy()
+        state_keys, state_idx = np.unique(states, return_inverse=True)
+        cases = df["numero_casos"].to_numpy(dtype=float)
+        known = ~np.isnan(cases)
+
+        state_cases = np.zeros((len(state_keys), n_weeks), dtype=float)
+        state_known = np.zeros((len(state_keys), n_weeks), dtype=np.int64)
+        np.add.at(state_cases, (state_idx[known], week_idx[known]), cases[known])
+        np.add.at(state_known, (state_idx[known], week_idx[known]), 1)
+
+        codes = df["codigo_ibge"].astype(int).to_numpy()
+        first = np.unique(codes, return_index=True)[1]
+        state_pop = np.zeros(len(state_keys), dtype=float)
+        np.add.at(state_pop, state_idx[first], [population.get(int(c), 0) for c in codes[first]])
+
+        # Estado -> região (cada estado pertence a uma única região)
+        state_to_region = (
+            pd.Series(df["regiao"].astype(str).to_numpy(), index=states).groupby(level=0).first()
+        )
+        region_of_state = state_to_region.reindex(state_keys).to_numpy()
+        region_keys, region_idx = np.unique(region_of_state, return_inverse=True)
+        membership = np.zeros((len(region_keys), len(state_keys)), dtype=float)
+        membership[region_idx, np.arange(len(state_keys))] = 1.0
+
+        self.keys = {
+            "brasil": np.array(["BR"]),
+            "regiao": np.array([str(k).upper() for k in region_keys]),
+            "estado": state_keys,
+        }
+        self.labels = {
+            "brasil": ["Brasil"],
+            "regiao": [str(k) for k in region_keys],
+            "estado": [str(k) for k in state_keys],
+        }
+        self.cases = {
+            "brasil": state_cases.sum(axis=0, keepdims=True),
+            "regiao": membership @ state_cases,
+            "estado": state_cases,
+        }
+        self.known = {
+            "brasil": state_known.sum(axis=0, keepdims=True),
+            "regiao": (membership @ state_known).astype(np.int64),
+            "estado": state_known,
+        }
+        self.population = {
+            "brasil": np.array([state_pop.sum()]),
+            "regiao": membership @ state_pop,
+            "estado": state_pop,
+        }
+        self.prefix = {
+            level: np.concatenate([np.zeros((m.shape[0], 1)), np.cumsum(m, axis=1)], axis=1)
+            for level, m in self.cases.items()
+        }
+        self.key_index = {level: {k: i for i, k in enumerate(keys)} for level, keys in self.keys.items()}
+
+    @staticmethod
+    def parse_week(value):
+        if value is None:
+            return None
+        if isinstance(value, (list, tuple)):
+            year, week = value
+        else:
+            year, week = str(value).replace("-", "/").split("/")
+        return int(year) * 100 + int(week)
+
+    def _window(self, start=None, end=None):
+        start_key = self.parse_week(start)
+        end_key = self.parse_week(end)
+        lo = 0 if start_key is None else int(np.searchsorted(self.week_keys, start_key, side="left"))
+        hi = len(self.week_keys) if end_key is None else int(np.searchsorted(self.week_keys, end_key, side="right"))
+        if hi <= lo:
+            raise ValueError("Janela de semanas vazia ou fora do período disponível.")
+        return lo, hi
+
+    def _incidence(self, cases, population):
+        return float(cases / population * 1e5) if population > 0 else None
+
+    def query(self, level: str, key: str | None = None, start=None, end=None, weekly: bool = True):
+        if level not in self.levels:
+            raise ValueError(f"Nível '{level}' inválido. Opções: {list(self.levels)}")
+        lo, hi = self._window(start, end)
+        window = {
+            "start": f"{self.week_keys[lo] // 100}/{self.week_keys[lo] % 100:02d}",
+            "end": f"{self.week_keys[hi - 1] // 100}/{self.week_keys[hi - 1] % 100:02d}",
+        }
+        prefix = self.prefix[level]
+        pop = self.population[level]
+
+        if key is None and level != "brasil":
+            totals = prefix[:, hi] - prefix[:, lo]
+            return {
+                "level": level,
+                "window": window,
+                "totals": [
+                    {
+                        "key": self.labels[level][i],
+                        "cases": int(round(float(totals[i]))),
+                        "population": int(pop[i]),
+                        "incidence_per_100k": self._incidence(totals[i], pop[i]),
+                    }
+                    for i in range(len(totals))
+                ],
+            }
+
+        i = 0 if level == "brasil" else self.key_index[level].get(str(key).upper())
+        if i is None:
+            raise ValueError(f"'{key}' não encontrado no nível '{level}'.")
+        total = prefix[i, hi] - prefix[i, lo]
+        result = {
+            "level": level,
+            "key": self.labels[level][i],
+            "window": window,
+            "total_cases": int(round(float(total))),
+            "population": int(pop[i]),
+            "incidence_per_100k": self._incidence(total, pop[i]),
+        }
+        if weekly:
+            cases = self.cases[level][i, lo:hi]
+            known = self.known[level][i, lo:hi]
+            result["weekly"] = [
+                {
+                    "week": f"{self.week_keys[j] // 100}/{self.week_keys[j] % 100:02d}",
+                    "date": self.week_dates[j],
+                    "cases": int(round(float(c))) if k > 0 else None,
+                    "incidence_per_100k": self._incidence(c, pop[i]) if k > 0 else None,
+                }
+                for j, c, k in zip(range(lo, hi), cases, known)
+            ]
+        return result
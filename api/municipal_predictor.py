@@ -14,8 +14,15 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from huggingface_hub import hf_hub_download
 
+from historic_rollup import HistoricRollup
+from municipio_locator import MunicipioLocator
+from municipio_search import MunicipioSearchIndex
+
 plt.style.use('seaborn-v0_8-darkgrid')
 
+# População por município gerada pelo pipeline de dados (ai_predict/data/pipeline_scripts/population.py)
+POPULATION_SOURCE = Path(__file__).resolve().parent.parent / "ai_predict" / "data" / "municipios" / "populacao_2025.json"
+
 @register_keras_serializable(package="Custom", name="asymmetric_mse")
 def asymmetric_mse(y_true, y_pred):
     penalty_factor = 10.0
@@ -41,6 +48,9 @@ class DenguePredictor:
             "week_sin", "week_cos", "year_norm", "notificacao"
         ]
         self.static_features = ["latitude", "longitude"]
+        # Janela (em semanas) usada para o ranking de focos: "próximo mês"
+        self.ranking_weeks = 4
+        self.ranking_metrics = ("growth_per_100k", "incidence", "growth", "cases")
         self.feature_names_pt = {
             "numero_casos": "Nº de Casos de Dengue",
             "T2M": "Temperatura Média (°C)",
@@ -68,6 +78,18 @@ class DenguePredictor:
         else:
             self.city_to_idx = {}
 
+        # No Space a cópia em models/ é feita no deploy; no repositório vale o arquivo do pipeline de dados
+        population_path = models_dir / "populacao_2025.json"
+        if not population_path.exists():
+            population_path = POPULATION_SOURCE
+        if population_path.exists():
+            with open(population_path, "r", encoding="utf-8-sig") as fh:
+                self.population = {int(k): int(v) for k, v in json.load(fh).items()}
+        else:
+            self.population = {}
+            print(f"[WARN] População por município não encontrada ({models_dir / 'populacao_2025.json'} "
+                  f"nem {POPULATION_SOURCE}); rankings por 100 mil habitantes ficarão indisponíveis.")
+
         # Load inference dataset (HF online or local offline)
         df = None
         if self.offline:
@@ -114,6 +136,9 @@ class DenguePredictor:
 
         self.df_master = df
         self.municipios = df[["codigo_ibge", "municipio"]].drop_duplicates().sort_values("codigo_ibge")
+        self.locator = MunicipioLocator(df)
+        self.search_index = MunicipioSearchIndex(df, self.population)
+        self.rollup = HistoricRollup(df, self.population) if {"estado_sigla", "regiao"}.issubset(df.columns) else None
 
         if not model_path.exists():
             raise FileNotFoundError(str(model_path) + " not found")
@@ -121,6 +146,9 @@ class DenguePredictor:
         self.model = tf.keras.models.load_model(model_path, custom_objects={"asymmetric_mse": asymmetric_mse}, compile=False)
         self._loaded = True
 
+        # Previsões de todos os municípios numa única passada, usadas pelas agregações por grupo
+        self.build_forecast_table()
+
     def plot_to_base64(self, fig):
         buf = BytesIO()
         fig.savefig(buf, format="png", bbox_inches="tight", facecolor=fig.get_facecolor())
@@ -143,6 +171,226 @@ class DenguePredictor:
             df_seq["notificacao"] = df_seq["notificacao"].astype(float)
         return df_seq
 
+    def _prepare_batch_sequences(self, df: pd.DataFrame):
+        # Equivalente vetorizado de _prepare_sequence para vários municípios de uma vez.
+        # df deve estar ordenado por codigo_ibge/date, como self.df_master.
+        total_rows = df.groupby("codigo_ibge", sort=False).size()
+        df_clean = df.dropna(subset=["numero_casos"])
+        df_seq = df_clean.groupby("codigo_ibge", sort=False).tail(self.sequence_length)
+        seq_rows = df_seq.groupby("codigo_ibge", sort=False).size()
+        valid = seq_rows.index[
+            (seq_rows.values == self.sequence_length)
+            & (total_rows.reindex(seq_rows.index).values >= self.sequence_length)
+        ]
+        df_seq = df_seq[df_seq["codigo_ibge"].isin(valid)].copy()
+
+        by_city = df_seq.groupby("codigo_ibge", sort=False)
+        df_seq["casos_velocidade"] = by_city["numero_casos"].diff().fillna(0)
+        df_seq["casos_aceleracao"] = df_seq.groupby("codigo_ibge", sort=False)["casos_velocidade"].diff().fillna(0)
+        df_seq["casos_mm_4_semanas"] = (
+            by_city["numero_casos"].rolling(4, min_periods=1).mean().reset_index(level=0, drop=True)
+        )
+        df_seq["week_sin"] = np.sin(2 * np.pi * df_seq["semana"] / 52)
+        df_seq["week_cos"] = np.cos(2 * np.pi * df_seq["semana"] / 52)
+        df_seq["year_norm"] = (df_seq["ano"] - self.year_min_train) / (self.year_max_train - self.year_min_train)
+        if "notificacao" not in df_seq.columns:
+            df_seq["notificacao"] = df_seq["ano"].isin([2021, 2022]).astype(float)
+        else:
+            df_seq["notificacao"] = df_seq["notificacao"].astype(float)
+        return df_seq
+
+    def predict_batch(self, df: pd.DataFrame, batch_size: int = 1024):
+        """Prevê o horizonte completo para todos os municípios de `df` numa passada do modelo.
+
+        Retorna (df_last, preds): df_last tem a última semana conhecida de cada município
+        e preds é uma matriz (n_municipios, horizon) com os casos previstos.
+        """
+        df_seq = self._prepare_batch_sequences(df)
+        n = len(df_seq) // self.sequence_length
+        if n == 0:
+            return df_seq.iloc[0:0], np.zeros((0, self.horizon), dtype=float)
+
+        dynamic_raw = df_seq[self.dynamic_features].values
+        dynamic_scaled = self.scaler_dyn.transform(dynamic_raw).reshape(n, self.sequence_length, -1)
+
+        df_last = df_seq.iloc[self.sequence_length - 1::self.sequence_length].reset_index(drop=True)
+        static_scaled = self.scaler_static.transform(df_last[self.static_features].values)
+
+        codes = df_last["codigo_ibge"].astype(int).tolist()
+        city_input = np.array([[int(self.city_to_idx.get(c, 0))] for c in codes], dtype=np.int32)
+
+        y_pred = self.model.predict([dynamic_scaled, static_scaled, city_input], batch_size=batch_size, verbose=0)
+        y_pred_reg = y_pred[0] if isinstance(y_pred, (list, tuple)) else y_pred
+        y_pred_inv = self.scaler_target.inverse_transform(y_pred_reg.reshape(-1, 1)).reshape(n, -1)
+        return df_last, np.maximum(y_pred_inv, 0.0)
+
+    def build_forecast_table(self):
+        df_last, preds = self.predict_batch(self.df_master)
+        codes = df_last["codigo_ibge"].astype(int).to_numpy()
+
+        self.forecast_codes = codes
+        self.forecast_matrix = preds
+        self.forecast_last_cases = df_last["numero_casos"].to_numpy(dtype=float)
+        # Última semana observada de cada município: as séries não terminam todas na mesma data
+        self.forecast_last_dates = (pd.to_datetime(df_last["date"]).to_numpy() if "date" in df_last.columns
+                                    else np.full(len(codes), np.datetime64("NaT"), dtype="datetime64[ns]"))
+        self.forecast_row = {int(c): i for i, c in enumerate(codes)}
+        self.forecast_names = df_last["municipio"].astype(str).to_numpy()
+        self.forecast_uf = df_last["estado_sigla"].to_numpy() if "estado_sigla" in df_last.columns else np.full(len(codes), None)
+        self.forecast_regiao = df_last["regiao"].to_numpy() if "regiao" in df_last.columns else np.full(len(codes), None)
+
+        # Índice grupo -> linhas da tabela de previsões
+        self.group_index = {}
+        for level, col in (("regiao", "regiao"), ("estado", "estado_sigla")):
+            if col not in df_last.columns:
+                continue
+            keys = df_last[col].astype(str).str.upper().to_numpy()
+            self.group_index[level] = {
+                k: np.flatnonzero(keys == k) for k in np.unique(keys[df_last[col].notna().to_numpy()])
+            }
+
+        self._build_rankings()
+
+    def _build_rankings(self):
+        weeks = self.ranking_weeks
+        codes = self.forecast_codes
+        pop = np.array([self.population.get(int(c), np.nan) for c in codes], dtype=float)
+        pop[pop <= 0] = np.nan
+
+        df_clean = self.df_master.dropna(subset=["numero_casos"])
+        recent = df_clean.groupby("codigo_ibge", sort=False).tail(weeks).groupby("codigo_ibge")["numero_casos"].sum()
+        recent = recent.reindex(codes).to_numpy(dtype=float)
+
+        upcoming = self.forecast_matrix[:, :weeks].sum(axis=1)
+        growth = upcoming - recent
+        self.ranking_population = pop
+        self.ranking_recent = recent
+        self.ranking_values = {
+            "cases": upcoming,
+            "growth": growth,
+            "incidence": upcoming / pop * 1e5,
+            "growth_per_100k": growth / pop * 1e5,
+        }
+        # Ordem decrescente pré-calculada por métrica; NaN (sem população) vai para o final
+        self.ranking_order = {
+            metric: np.argsort(-np.nan_to_num(values, nan=-np.inf), kind="stable")
+            for metric, values in self.ranking_values.items()
+        }
+
+    def rank_hotspots(self, metric: str = "growth_per_100k", k: int = 50, state: str | None = None, regiao: str | None = None):
+        if not self._loaded:
+            raise RuntimeError("assets not loaded")
+        if metric not in self.ranking_order:
+            raise ValueError(f"Métrica '{metric}' inválida. Opções: {list(self.ranking_metrics)}")
+        if metric in ("incidence", "growth_per_100k") and not self.population:
+            raise ValueError(f"Métrica '{metric}' requer dados de população, que não foram carregados. "
+                             f"Use 'cases' ou 'growth'.")
+        k = max(1, int(k))
+
+        order = self.ranking_order[metric]
+        values = self.ranking_values[metric]
+        allowed = None
+        for level, key in (("estado", state), ("regiao", regiao)):
+            if not key:
+                continue
+            rows, _ = self._group_rows(level, key=key)
+            mask = np.zeros(len(order), dtype=bool)
+            mask[rows] = True
+            allowed = mask if allowed is None else (allowed & mask)
+        if allowed is not None:
+            order = order[allowed[order]]
+        order = order[~np.isnan(values[order])][:k]
+
+        ranking = []
+        for pos, r in enumerate(order, start=1):
+            pop = self.ranking_population[r]
+            ranking.append({
+                "rank": pos,
+                "ibge": int(self.forecast_codes[r]),
+                "municipio": self.forecast_names[r],
+                "estado_sigla": self.forecast_uf[r],
+                "regiao": self.forecast_regiao[r],
+                "population": int(pop) if not np.isnan(pop) else None,
+                "value": float(values[r]),
+                "recent_cases": int(round(float(self.ranking_recent[r]))) if not np.isnan(self.ranking_recent[r]) else None,
+                "predicted_cases": int(round(float(self.ranking_values["cases"][r]))),
+            })
+        return {
+            "metric": metric,
+            "weeks": self.ranking_weeks,
+            "filters": {"state": state, "regiao": regiao},
+            "ranking": ranking,
+        }
+
+    def _group_rows(self, level: str, key=None, ibge_codes=None):
+        if level == "ibge":
+            rows, missing = [], []
+            for code in ibge_codes or []:
+                r = self.forecast_row.get(int(code))
+                if r is None:
+                    missing.append(int(code))
+                else:
+                    rows.append(r)
+            return np.unique(np.array(rows, dtype=int)), missing
+        if level not in self.group_index:
+            raise ValueError(f"Agrupamento '{level}' não disponível nos dados de inferência.")
+        rows = self.group_index[level].get(str(key).upper())
+        if rows is None:
+            raise ValueError(f"Grupo '{key}' não encontrado para o nível '{level}'.")
+        return rows, []
+
+    def predict_group(self, level: str, key=None, ibge_codes=None, include_members: bool = False):
+        if not self._loaded:
+            raise RuntimeError("assets not loaded")
+        rows, missing = self._group_rows(level, key=key, ibge_codes=ibge_codes)
+        if len(rows) == 0:
+            raise ValueError("Nenhum município com previsão disponível no grupo solicitado.")
+
+        horizon = self.forecast_matrix.shape[1]
+        member_dates = pd.DatetimeIndex(self.forecast_last_dates[rows])
+        stale = []
+        if member_dates.notna().all():
+            # Municípios cuja previsão inteira termina antes da última semana observada do grupo
+            # não têm nenhuma semana em comum com os demais: saem da soma e são listados à parte
+            lag = np.asarray((member_dates.max() - member_dates).days // 7, dtype=int)
+            fresh = lag < horizon
+            stale = [int(c) for c in self.forecast_codes[rows[~fresh]]]
+            rows, lag = rows[fresh], lag[fresh]
+            # Alinha cada município pela própria data e soma só as semanas previstas para todos
+            start = int(lag.max())
+            totals = np.zeros(horizon - start)
+            for r, off in zip(rows, start - lag):
+                totals += self.forecast_matrix[r, start - off:horizon - off]
+            last_date = member_dates.max()
+        else:
+            totals = self.forecast_matrix[rows].sum(axis=0)
+            last_date = pd.NaT
+        predicted_data = []
+        for i, val in enumerate(totals):
+            pred_date = (last_date + timedelta(weeks=i + 1)).strftime("%Y-%m-%d") if pd.notna(last_date) else None
+            predicted_data.append({"date": pred_date, "predicted_cases": int(round(float(val)))})
+
+        result = {
+            "group": {"level": level, "key": key if level != "ibge" else None},
+            "n_municipios": int(len(rows)),
+            "missing_ibge": missing,
+            "stale_ibge": stale,
+            "last_known_date": last_date.strftime("%Y-%m-%d") if pd.notna(last_date) else None,
+            "last_known_cases": int(round(float(np.nansum(self.forecast_last_cases[rows])))),
+            "predicted_data": predicted_data,
+        }
+        if include_members:
+            result["members"] = [
+                {
+                    "ibge": int(self.forecast_codes[r]),
+                    "last_known_date": (pd.Timestamp(self.forecast_last_dates[r]).strftime("%Y-%m-%d")
+                                        if pd.notna(self.forecast_last_dates[r]) else None),
+                    "predicted_cases": [int(round(float(v))) for v in self.forecast_matrix[r]],
+                }
+                for r in rows
+            ]
+        return result
+
     def predict(self, ibge_code: int, show_plot=False, display_history_weeks=None):
         if not self._loaded:
             raise RuntimeError("assets not loaded")
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+class MunicipioLocator:
+    """Índice espacial (BallTree com distância haversine) sobre as sedes dos municípios."""
+
+    def __init__(self, df: pd.DataFrame):
+        cols = [c for c in ("codigo_ibge", "municipio", "estado_sigla", "latitude", "longitude") if c in df.columns]
+        df_geo = (
+            df[cols]
+            .dropna(subset=["latitude", "longitude"])
+            .drop_duplicates(subset=["codigo_ibge"])
+            .reset_index(drop=True)
+        )
+        if df_geo.empty:
+            raise ValueError("Nenhum município com latitude/longitude para o índice espacial.")
+
+        self.codes = df_geo["codigo_ibge"].astype(int).to_numpy()
+        self.names = df_geo["municipio"].astype(str).to_numpy() if "municipio" in df_geo.columns else self.codes.astype(str)
+        self.ufs = df_geo["estado_sigla"].to_numpy() if "estado_sigla" in df_geo.columns else np.full(len(df_geo), None)
+        self.coords = df_geo[["latitude", "longitude"]].to_numpy(dtype=float)
+        self.tree = BallTree(np.radians(self.coords), metric="haversine")
+
+    def nearest(self, lat: float, lon: float, k: int = 1):
+        lat, lon = float(lat), float(lon)
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+            raise ValueError("Coordenadas inválidas: 'lat' deve estar em [-90, 90] e 'lon' em [-180, 180].")
+        k = max(1, min(int(k), len(self.codes)))
+        dist, idx = self.tree.query(np.radians([[lat, lon]]), k=k)
+        return [
+            {
+                "ibge": int(self.codes[i]),
+                "municipio": self.names[i],
+                "estado_sigla": self.ufs[i],
+                "latitude": float(self.coords[i, 0]),
+                "longitude": float(self.coords[i, 1]),
+                "distance_km": round(float(d) * EARTH_RADIUS_KM, 3),
+            }
+            for d, i in zip(dist[0], idx[0])
+        ]
@@ -0,0 +1,91 @@
+import re
+import unicodedata
+from bisect import bisect_left
+
+import numpy as np
+import pandas as pd
+
+
+def fold_text(value) -> str:
+    # Minúsculas, sem acentos e com pontuação trocada por espaço: "São Luís" -> "sao luis"
+    text = unicodedata.normalize("NFKD", str(value))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    return re.sub(r"[^a-z0-9]+", " ", text).strip()
+
+
+class MunicipioSearchIndex:
+    """Índice de prefixos (array ordenado + bisect) sobre nomes de municípios sem acentos.
+
+    Cada município entra uma vez pelo nome completo e uma vez por palavra
+    interna ("sao jose dos campos" também é encontrado por "campos").
+    """
+
+    def __init__(self, df: pd.DataFrame, population: dict | None = None):
+        population = population or {}
+        cols = [c for c in ("codigo_ibge", "municipio", "estado_sigla") if c in df.columns]
+        df_names = df[cols].dropna(subset=["municipio"]).drop_duplicates(subset=["codigo_ibge"]).reset_index(drop=True)
+
+        self.codes = df_names["codigo_ibge"].astype(int).to_numpy()
+        self.names = df_names["municipio"].astype(str).to_numpy()
+        self.ufs = (
+            df_names["estado_sigla"].fillna("").astype(str).str.upper().to_numpy()
+            if "estado_sigla" in df_names.columns else np.full(len(df_names), "")
+        )
+        self.population = np.array([population.get(int(c), 0) for c in self.codes], dtype=np.int64)
+        self.folded = [fold_text(n) for n in self.names]
+        self.uf_set = {uf.lower() for uf in self.ufs if uf}
+        self.name_set = set(self.folded)
+
+        entries = []
+        for row, name in enumerate(self.folded):
+            words = name.split(" ")
+            for w in range(len(words)):
+                # Peso 0 = início do nome completo, 1 = início de palavra interna
+                entries.append((" ".join(words[w:]), 0 if w == 0 else 1, row))
+        entries.sort()
+        self.keys = [e[0] for e in entries]
+        self.entry_kind = [e[1] for e in entries]
+        self.entry_row = [e[2] for e in entries]
+
+    def _split_uf(self, query: str):
+        # "campinas sp" -> ("campinas", "SP"). Só vale quando o resto já é um nome completo e o
+        # texto inteiro não continua nenhum nome: em "sao pa" ou "porto al" o usuário ainda está
+        # digitando "sao paulo"/"porto alegre", e o último termo não é o estado
+        parts = query.split(" ")
+        head = " ".join(parts[:-1])
+        if len(parts) > 1 and parts[-1] in self.uf_set and head in self.name_set and not self._has_prefix(query):
+            return head, parts[-1].upper()
+        return query, None
+
+    def _has_prefix(self, query: str):
+        i = bisect_left(self.keys, query)
+        return i < len(self.keys) and self.keys[i].startswith(query)
+
+    def search(self, query: str, limit: int = 10, uf: str | None = None):
+        q = fold_text(query)
+        if not q:
+            return []
+        q, uf_from_query = self._split_uf(q)
+        uf = (uf or uf_from_query or "").upper() or None
+        limit = max(1, int(limit))
+
+        best = {}
+        i = bisect_left(self.keys, q)
+        while i < len(self.keys) and self.keys[i].startswith(q):
+            row = self.entry_row[i]
+            if uf is None or self.ufs[row] == uf:
+                rank = 0 if self.keys[i] == q and self.entry_kind[i] == 0 else 1 + self.entry_kind[i]
+                if rank < best.get(row, 3):
+                    best[row] = rank
+            i += 1
+
+        rows = sorted(best, key=lambda r: (best[r], -self.population[r], self.folded[r]))[:limit]
+        return [
+            {
+                "ibge": int(self.codes[r]),
+                "municipio": self.names[r],
+                "estado_sigla": self.ufs[r] or None,
+                "match": ("exact", "prefix", "word")[best[r]],
+            }
+            for r in rows
+        ]
@@ -0,0 +1,51 @@
+import json
+from pathlib import Path
+
+import pandas as pd
+
+from municipio_search import MunicipioSearchIndex
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "ai_predict" / "data" / "municipios"
+UF_SIGLAS = {
+    11: "RO", 12: "AC", 13: "AM", 14: "RR", 15: "PA", 16: "AP", 17: "TO", 21: "MA", 22: "PI",
+    23: "CE", 24: "RN", 25: "PB", 26: "PE", 27: "AL", 28: "SE", 29: "BA", 31: "MG", 32: "ES",
+    33: "RJ", 35: "SP", 41: "PR", 42: "SC", 43: "RS", 50: "MS", 51: "MT", 52: "GO", 53: "DF",
+}
+
+
+def _index():
+    with open(DATA_DIR / "municipios.json", encoding="utf-8-sig") as fh:
+        municipios = json.load(fh)
+    with open(DATA_DIR / "populacao_2025.json", encoding="utf-8-sig") as fh:
+        population = {int(k): int(v) for k, v in json.load(fh).items()}
+    df = pd.DataFrame({
+        "codigo_ibge": [m["codigo_ibge"] for m in municipios],
+        "municipio": [m["nome"] for m in municipios],
+        "estado_sigla": [UF_SIGLAS[m["codigo_uf"]] for m in municipios],
+    })
+    return MunicipioSearchIndex(df, population)
+
+
+INDEX = _index()
+
+
+def test_partial_word_matching_uf_is_still_a_prefix():
+    results = INDEX.search("sao pa")
+    assert results[0]["municipio"] == "São Paulo"
+    assert {r["estado_sigla"] for r in results} != {"PA"}
+
+
+def test_other_partial_names_are_not_filtered_by_uf():
+    assert any(r["estado_sigla"] != "MA" for r in INDEX.search("santa ma"))
+    assert INDEX.search("porto al")[0]["municipio"] == "Porto Alegre"
+
+
+def test_trailing_uf_after_complete_name_filters():
+    results = INDEX.search("campinas sp")
+    assert results and all(r["estado_sigla"] == "SP" for r in results)
+    assert results[0]["municipio"] == "Campinas"
+
+
+def test_explicit_uf_parameter():
+    results = INDEX.search("sao", uf="PA")
+    assert results and all(r["estado_sigla"] == "PA" for r in results)
@@ -0,0 +1,55 @@
+import threading
+import time
+
+from tile_batcher import TileBatcher
+
+
+def _recording_infer(order, lock, gate):
+    def infer(tiles, key):
+        with lock:
+            order.append(key)
+        gate.wait(timeout=5)
+        return [(key, tile) for tile in tiles]
+    return infer
+
+
+def test_results_follow_submission_order():
+    batcher = TileBatcher(lambda tiles, key: [t * 2 for t in tiles], max_batch=3, max_wait_ms=1)
+    assert batcher.infer(list(range(10)), key="a") == [t * 2 for t in range(10)]
+
+
+def test_busy_key_does_not_starve_other_keys():
+    for replicas in (1, 2):
+        order, lock, gate = [], threading.Lock(), threading.Event()
+        batcher = TileBatcher([_recording_infer(order, lock, gate) for _ in range(replicas)],
+                              max_batch=2, max_wait_ms=0)
+
+        busy = batcher.submit(list(range(60)), key="a")
+        while len(order) < replicas:
+            time.sleep(0.001)
+        # Todas as réplicas estão ocupadas com "a" quando "b" chega
+        other = batcher.submit([0], key="b")
+        gate.set()
+        assert other[0].result(timeout=5) == ("b", 0)
+        # "b" entra no rodízio logo em seguida, sem esperar os 30 lotes de "a"
+        assert order.index("b") <= 2 * replicas
+        assert all(f.result(timeout=5)[0] == "a" for f in busy)
+
+
+def test_mixed_keys_are_never_batched_together():
+    seen = []
+
+    def infer(tiles, key):
+        seen.append({tile[0] for tile in tiles} | {key})
+        return tiles
+
+    batcher = TileBatcher([infer, infer], max_batch=4, max_wait_ms=2)
+    threads = [
+        threading.Thread(target=batcher.infer, args=([(k, i) for i in range(9)],), kwargs={"key": k})
+        for k in "abc" for _ in range(3)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=5)
+    assert seen and all(len(s) == 1 for s in seen)
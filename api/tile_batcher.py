@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+
+class TileBatcher:
+    """Agrupa tiles de várias requisições simultâneas em lotes do modelo.
+
+    Threads de trabalho consomem a fila compartilhada e montam lotes de até
+    `max_batch` tiles; se ainda não houver tiles suficientes, espera no máximo
+    `max_wait_ms` por tiles de outras requisições antes de rodar o lote.
+    Tiles com chaves diferentes (ex.: imgsz/conf de presets distintos) nunca
+    são misturados no mesmo lote. Com vários `infer_fn` (réplicas do modelo),
+    cada um ganha sua própria thread e todas consomem a mesma fila.
+    """
+
+    def __init__(self, infer_fn, max_batch: int = 8, max_wait_ms: float = 10.0):
+        self.infer_fns = list(infer_fn) if isinstance(infer_fn, (list, tuple)) else [infer_fn]
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self.stats = {"batches": 0, "tiles": 0}
+        self._workers = [
+            threading.Thread(target=self._run, args=(fn,), name=f"tile-batcher-{i}", daemon=True)
+            for i, fn in enumerate(self.infer_fns)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, tiles, key=None):
+        futures = [Future() for _ in tiles]
+        if not futures:
+            return futures
+        with self._cond:
+            self._pending.setdefault(key, deque()).extend(zip(tiles, futures))
+            self._cond.notify()
+        return futures
+
+    def infer(self, tiles, key=None):
+        return [f.result() for f in self.submit(tiles, key=key)]
+
+    def _collect(self):
+        with self._cond:
+            while True:
+                while not self._pending:
+                    self._cond.wait()
+                # Rodízio entre chaves: a escolhida vai para o final, de modo que uma chave
+                # sempre cheia não segura as outras e cada réplica pega uma chave diferente
+                key = next(iter(self._pending))
+                self._pending.move_to_end(key)
+                deadline = time.monotonic() + self.max_wait
+                while key in self._pending and len(self._pending[key]) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if key not in self._pending:
+                    # Outra réplica levou esses tiles enquanto esperávamos
+                    continue
+                items = self._pending[key]
+                batch = [items.popleft() for _ in range(min(self.max_batch, len(items)))]
+                if not items:
+                    del self._pending[key]
+                if self._pending:
+                    self._cond.notify()
+                return key, batch
+
+    def _run(self, infer_fn):
+        while True:
+            key, batch = self._collect()
+            batch = [(tile, fut) for tile, fut in batch if fut.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                outputs = infer_fn([tile for tile, _ in batch], key)
+                for (_, fut), out in zip(batch, outputs):
+                    fut.set_result(out)
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+            with self._cond:
+                self.stats["batches"] += 1
+                self.stats["tiles"] += len(batch)